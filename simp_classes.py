@@ -1,6 +1,15 @@
 #!/usr/bin/env python3
 
+import hashlib
+import heapq
+import hmac
+import itertools
+import secrets
+import threading
+import time
+from collections import OrderedDict
 from enum import Enum
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 # Types and enums
 
@@ -12,16 +21,41 @@ class OperationType(Enum):
     SYNACK = 0x06  # Combination of SYN and ACK
     FIN = 0x08
     FINERR = 0x09  # Combination of FIN and ERR
+    ANNOUNCE = 0x10  # Peer discovery, "this user is reachable at this address"
+    KEEPALIVE = 0x20  # Probe of an idle chat, "are you still there?"
+    KEEPALIVEACK = 0x24  # Combination of KEEPALIVE and ACK
 
 
 class MessageType(Enum):
     CONTROL = 0x01
     CHAT = 0x02
+    GROUP = 0x03  # Group chat, with its own sequence numbers per sender and member
+    SECURE = 0x04  # Encrypted and authenticated datagram of a session, the payload is binary (see `SessionCipher`)
+
+
+# 2048-bit MODP group of RFC 3526 (generator 2), used for the Diffie-Hellman key exchange of the handshake
+MODP_PRIME: int = int(
+    'FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020BBEA63B139B22514A08798E3404DD'
+    'EF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED'
+    'EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF0598DA48361C55D39A69163FA8FD24CF5F'
+    '83655D23DCA3AD961C62F356208552BB9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B'
+    'E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF6955817183995497CEA956AE515D2261898FA0510'
+    '15728E5A8AACAA68FFFFFFFFFFFFFFFF', 16)
+MODP_GENERATOR: int = 2
+
+# Group chat messages start with the id of their group and their message number (8 hex digits each) and a space
+# - the single bit sequence number can't tell a late retransmission from the message after next, the message number can
+# - every new group numbers its messages from 0 again, so its members tell them apart by the group id
+GROUP_ID_LENGTH: int = 8
+GROUP_PREFIX_LENGTH: int = 2 * GROUP_ID_LENGTH
 
 
 # Classes
 class Header:
     def __init__(self, header_data: bytes):
+        # Every malformed header raises a ValueError (invalid enum values and non-ASCII users included)
+        if len(header_data) != 39:
+            raise ValueError('Header must be 39 bytes long.')
         self.bytes: bytes = header_data
         self.message_type: MessageType = MessageType(
             header_data[0])  # 0x01, 0x02
@@ -29,22 +63,30 @@ class Header:
             header_data[1])  # 0x01, 0x02, 0x04, 0x08
         # 0x00 or 0x01, alternating
         self.sequence_number: int = header_data[2]
+        if self.sequence_number not in [0x00, 0x01]:
+            raise ValueError('Sequence_number must be 0x00 or 0x01.')
         self.user: str = header_data[3:35].decode(
-            'ascii')  # User name, 32 bytes, ASCII
+            'ascii').rstrip('\x00')  # User name, 32 bytes, ASCII, padded with null bytes
         self.payload_size: int = int.from_bytes(
             header_data[35:39], 'big')  # Size of the payload, 4 bytes
 
 
 class Payload:
-    def __init__(self, payload_data: bytes):
+    def __init__(self, payload_data: bytes, binary: bool = False):
         self.bytes: bytes = payload_data
-        self.message: str = payload_data.decode('ascii')
+        # Binary payloads (of SECURE datagrams) are shown as hex
+        self.message: str = payload_data.hex() if binary else payload_data.decode('ascii')
 
 
 class Datagram:
     def __init__(self, data: bytes):
+        self.bytes: bytes = data
         self.header: Header = Header(data[0:39])
-        self.payload: bytes = Payload(data[39:])
+        if len(data) - 39 != self.header.payload_size:
+            raise ValueError(
+                'Payload size does not match the length of the payload.')
+        self.payload: Payload = Payload(
+            data[39:], binary=self.header.message_type == MessageType.SECURE)
 
     def __str__(self):
         return f'''Datagram:
@@ -56,6 +98,359 @@ class Datagram:
     Payload: {self.payload.message}'''
 
 
+class ReceiveCache:
+    # Remembers the last datagram accepted from each peer together with the ACK that answered it
+    # - if that ACK gets lost the peer retransmits, and the duplicate is answered from here instead of being delivered again
+    # - entries are keyed by (address, sequence number), bounded in number and evicted after `ttl` seconds
+    def __init__(self, max_entries: int = 64, ttl: float = 30.0) -> None:
+        self.max_entries: int = max_entries
+        self.ttl: float = ttl
+        # (addr, sequence number) -> (datagram bytes, ACK bytes, expiry time), ordered by expiry
+        self.entries: OrderedDict[Tuple[Tuple[str, int], int], Tuple[bytes, bytes, float]] = OrderedDict()
+
+    # Remember an accepted datagram and the ACK we replied with
+    def store(self, addr: Tuple[str, int], data: bytes, ack: bytes) -> None:
+        now: float = time.time()
+        sequence_number: int = data[2]
+        # A peer only ever retransmits the latest datagram it sent, so the entry for the other sequence number is stale
+        self.entries.pop((addr, sequence_number ^ 0x01), None)
+        key: Tuple[Tuple[str, int], int] = (addr, sequence_number)
+        self.entries[key] = (data, ack, now + self.ttl)
+        self.entries.move_to_end(key)
+        self.evict(now)
+
+    # Return the cached ACK if `data` is a retransmission of the last datagram accepted from `addr`
+    def lookup(self, addr: Tuple[str, int], data: bytes) -> Optional[bytes]:
+        if len(data) < 3:
+            return None
+        entry = self.entries.get((addr, data[2]))
+        if entry is None:
+            return None
+        cached_data, ack, expires_at = entry
+        if expires_at < time.time():
+            del self.entries[(addr, data[2])]
+            return None
+        if cached_data != data:
+            return None
+        return ack
+
+    # Drop everything cached for a peer, e.g. when a new chat with them starts
+    def forget(self, addr: Tuple[str, int]) -> None:
+        for key in [key for key in self.entries if key[0] == addr]:
+            del self.entries[key]
+
+    def evict(self, now: float) -> None:
+        # Entries are ordered by expiry, so expired ones are always at the front
+        while self.entries:
+            key, (_, _, expires_at) = next(iter(self.entries.items()))
+            if expires_at >= now and len(self.entries) <= self.max_entries:
+                break
+            del self.entries[key]
+
+    # JSON compatible state, for handing over to a restarted daemon
+    def to_dict(self) -> Dict[str, Any]:
+        return {'max_entries': self.max_entries, 'ttl': self.ttl, 'entries': [
+            [list(addr), sequence_number, data.hex(), ack.hex(), expires_at]
+            for (addr, sequence_number), (data, ack, expires_at) in self.entries.items()]}
+
+    @classmethod
+    def from_dict(cls, state: Dict[str, Any]) -> "ReceiveCache":
+        cache: ReceiveCache = cls(state['max_entries'], state['ttl'])
+        for addr, sequence_number, data, ack, expires_at in state['entries']:
+            cache.entries[((addr[0], addr[1]), sequence_number)] = (
+                bytes.fromhex(data), bytes.fromhex(ack), expires_at)
+        return cache
+
+
+class RetransmissionTimer:
+    # Adaptive retransmission timeout, estimated from measured round trip times (as in RFC 6298)
+    # - a successful ACK gives an RTT sample that pulls the timeout towards SRTT + 4 * RTTVAR
+    # - a timeout is treated as a congestion signal and doubles the timeout (exponential backoff)
+    def __init__(self, initial_rto: float = 5.0, min_rto: float = 1.0, max_rto: float = 30.0) -> None:
+        self.rto: float = initial_rto
+        self.min_rto: float = min_rto
+        self.max_rto: float = max_rto
+        self.srtt: Optional[float] = None  # Smoothed round trip time
+        self.rttvar: Optional[float] = None  # Round trip time variation
+
+    # Only call this for datagrams that were sent once, the ACK of a retransmission is ambiguous (Karn's algorithm)
+    def on_rtt_sample(self, rtt: float) -> None:
+        if self.srtt is None or self.rttvar is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar,
+                       self.min_rto), self.max_rto)
+
+    def on_timeout(self) -> None:
+        self.rto = min(self.rto * 2, self.max_rto)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, state: Dict[str, Any]) -> "RetransmissionTimer":
+        timer: RetransmissionTimer = cls()
+        vars(timer).update(state)
+        return timer
+
+
+class PeerCache:
+    # Username -> daemon address, filled by the ANNOUNCE datagrams of other daemons
+    # - entries expire after `ttl` seconds, so peers that stopped announcing are forgotten
+    def __init__(self, ttl: float = 15.0) -> None:
+        self.ttl: float = ttl
+        self.entries: Dict[str, Tuple[Tuple[str, int], float]] = {}
+
+    # Store or refresh a peer, returns True if the peer (at this address) was not known before
+    def store(self, username: str, addr: Tuple[str, int]) -> bool:
+        is_new: bool = self.resolve(username) != addr
+        self.entries[username] = (addr, time.time() + self.ttl)
+        return is_new
+
+    def resolve(self, username: str) -> Optional[Tuple[str, int]]:
+        entry = self.entries.get(username)
+        if entry is None:
+            return None
+        addr, expires_at = entry
+        if expires_at < time.time():
+            del self.entries[username]
+            return None
+        return addr
+
+    def evict(self) -> None:
+        now: float = time.time()
+        for username in [username for username, (_, expires_at) in self.entries.items() if expires_at < now]:
+            del self.entries[username]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'ttl': self.ttl, 'entries': {username: [list(addr), expires_at] for username, (addr, expires_at) in self.entries.items()}}
+
+    @classmethod
+    def from_dict(cls, state: Dict[str, Any]) -> "PeerCache":
+        cache: PeerCache = cls(state['ttl'])
+        cache.entries = {username: ((addr[0], addr[1]), expires_at)
+                         for username, (addr, expires_at) in state['entries'].items()}
+        return cache
+
+
+class ReplayWindow:
+    # Sliding window over the nonces of received datagrams (as in IPsec, RFC 4303)
+    # - nonces are counters, bit i of `bitmap` is set if nonce `highest - i` was already received
+    # - anything older than the window or seen before is a replay, reordering within the window is fine
+    def __init__(self, size: int = 64) -> None:
+        self.size: int = size
+        self.highest: int = -1
+        self.bitmap: int = 0
+
+    def check(self, nonce: int) -> bool:
+        if nonce > self.highest:
+            return True
+        offset: int = self.highest - nonce
+        return offset < self.size and not self.bitmap >> offset & 1
+
+    # Only call this once the datagram was authenticated, otherwise forged nonces could move the window
+    def update(self, nonce: int) -> None:
+        if nonce > self.highest:
+            self.bitmap = (self.bitmap << (nonce - self.highest)
+                           | 1) & ((1 << self.size) - 1)
+            self.highest = nonce
+        else:
+            self.bitmap |= 1 << (self.highest - nonce)
+
+
+class KeyExchange:
+    # Ephemeral Diffie-Hellman, the public keys are exchanged (as hex) in the payloads of SYN and SYNACK
+    # - `private_key` is only given when an exchange in progress is handed over to a restarted daemon
+    def __init__(self, private_key: Optional[int] = None) -> None:
+        self.private_key: int = secrets.randbits(
+            256) if private_key is None else private_key
+        self.public_key: str = format(
+            pow(MODP_GENERATOR, self.private_key, MODP_PRIME), 'x')
+
+    @staticmethod
+    def parse_public_key(public_key: str) -> int:
+        try:
+            value: int = int(public_key, 16)
+        except ValueError:
+            raise ValueError('Public key must be hex.')
+        # 1 and p - 1 would make the shared secret guessable
+        if not 1 < value < MODP_PRIME - 1:
+            raise ValueError('Public key out of range.')
+        return value
+
+    # Derive the keys of the session, both sides get the same keys as long as they agree on who initiated it
+    def derive(self, peer_public_key: str, initiator: bool) -> "SessionCipher":
+        shared_secret: int = pow(self.parse_public_key(
+            peer_public_key), self.private_key, MODP_PRIME)
+        initiator_key, responder_key = (self.public_key, peer_public_key) if initiator else (
+            peer_public_key, self.public_key)
+        # Binding the public keys to the secret makes the keys depend on the whole exchange
+        master_key: bytes = hashlib.blake2b(shared_secret.to_bytes(256, 'big') + f'{initiator_key}:{responder_key}'.encode(
+            'ascii'), digest_size=64, person=b'SIMP-session').digest()
+        return SessionCipher(master_key, initiator)
+
+
+class SessionCipher:
+    # Authenticated encryption of whole datagrams with the keys of one session (encrypt-then-MAC, stdlib only)
+    # - the keystream is SHAKE-256 of the key and the nonce, the tag a keyed BLAKE2b over header, nonce and ciphertext
+    # - every direction has its own keys, and the nonce is a counter, so a keystream is never used twice
+    # - the keyed hash states are set up once per session, a datagram costs copying them and one pass of each
+    # - layout of the payload: nonce (8 bytes), encrypted datagram, tag (16 bytes)
+
+    def __init__(self, master_key: bytes, initiator: bool, next_nonce: int = 0) -> None:
+        # Kept for handing the session over to a restarted daemon
+        self.master_key: bytes = master_key
+        self.initiator: bool = initiator
+
+        def subkey(label: bytes) -> bytes:
+            return hashlib.blake2b(key=master_key, digest_size=32, person=label).digest()
+        send_direction, receive_direction = (
+            b'i2r', b'r2i') if initiator else (b'r2i', b'i2r')
+        self.send_stream = hashlib.shake_256(
+            subkey(b'SIMP-enc-' + send_direction))
+        self.send_mac = hashlib.blake2b(key=subkey(
+            b'SIMP-mac-' + send_direction), digest_size=16)
+        self.receive_stream = hashlib.shake_256(
+            subkey(b'SIMP-enc-' + receive_direction))
+        self.receive_mac = hashlib.blake2b(key=subkey(
+            b'SIMP-mac-' + receive_direction), digest_size=16)
+        # Sealing happens from several threads, taking the next value of a count is atomic
+        self.send_nonces: itertools.count = itertools.count(next_nonce)
+        self.replay_window: ReplayWindow = ReplayWindow()
+        # Set once the session ended, the keys are kept a bit longer for answering retransmissions
+        self.expires_at: Optional[float] = None
+
+    # Wrap a datagram into a SECURE datagram, the user stays readable so the receiver knows who sent it
+    def seal(self, datagram: bytes) -> bytes:
+        nonce: bytes = next(self.send_nonces).to_bytes(8, 'big')
+        stream = self.send_stream.copy()
+        stream.update(nonce)
+        ciphertext: bytes = (int.from_bytes(datagram, 'big') ^ int.from_bytes(
+            stream.digest(len(datagram)), 'big')).to_bytes(len(datagram), 'big')
+        sealed: bytes = b'\x04\x01\x00' + datagram[3:35] + (
+            len(datagram) + 24).to_bytes(4, 'big') + nonce + ciphertext  # SECURE, ERR, sequence number 0
+        mac = self.send_mac.copy()
+        mac.update(sealed)
+        return sealed + mac.digest()
+
+    # Unwrap a SECURE datagram, raises a ValueError if it was forged, tampered with or replayed
+    def open(self, data: bytes) -> bytes:
+        if len(data) < 63:  # Header, nonce and tag
+            raise ValueError('Secure datagram too short.')
+        mac = self.receive_mac.copy()
+        mac.update(data[:-16])
+        if not hmac.compare_digest(mac.digest(), data[-16:]):
+            raise ValueError('Secure datagram failed authentication.')
+        nonce: bytes = data[39:47]
+        counter: int = int.from_bytes(nonce, 'big')
+        if not self.replay_window.check(counter):
+            raise ValueError('Secure datagram was replayed.')
+        self.replay_window.update(counter)
+        ciphertext: bytes = data[47:-16]
+        stream = self.receive_stream.copy()
+        stream.update(nonce)
+        return (int.from_bytes(ciphertext, 'big') ^ int.from_bytes(
+            stream.digest(len(ciphertext)), 'big')).to_bytes(len(ciphertext), 'big')
+
+    # NOTE: This uses up a nonce, so the session must not seal anything afterwards
+    def to_dict(self) -> Dict[str, Any]:
+        return {'master_key': self.master_key.hex(), 'initiator': self.initiator, 'next_nonce': next(self.send_nonces),
+                'replay_highest': self.replay_window.highest, 'replay_bitmap': self.replay_window.bitmap, 'expires_at': self.expires_at}
+
+    @classmethod
+    def from_dict(cls, state: Dict[str, Any]) -> "SessionCipher":
+        session: SessionCipher = cls(bytes.fromhex(
+            state['master_key']), state['initiator'], state['next_nonce'])
+        session.replay_window.highest = state['replay_highest']
+        session.replay_window.bitmap = state['replay_bitmap']
+        session.expires_at = state['expires_at']
+        return session
+
+
+class Timer:
+    # A callback scheduled on a `TimerHeap`
+    __slots__ = ('deadline', 'order', 'callback', 'args')
+
+    def __init__(self, deadline: float, order: int, callback: Callable, args: Tuple) -> None:
+        self.deadline: float = deadline
+        self.order: int = order  # Timers with the same deadline fire in the order they were scheduled
+        self.callback: Optional[Callable] = callback
+        self.args: Tuple = args
+
+    def __lt__(self, other: "Timer") -> bool:
+        return (self.deadline, self.order) < (other.deadline, other.order)
+
+    def cancel(self) -> None:
+        self.callback = None
+
+
+class TimerHeap:
+    # The timers of every session run on this one thread, instead of a thread or polling loop per session
+    # - timers are kept in a heap ordered by deadline, so scheduling one and firing the next are O(log n),
+    #   and the thread sleeps until the earliest deadline (or until an earlier timer is scheduled)
+    # - cancelling only marks the timer, it is thrown away once it gets to the top of the heap (lazy deletion)
+    # - callbacks run on the timer thread, so they must be short and must not block
+    def __init__(self) -> None:
+        self.heap: List[Timer] = []
+        self.condition: threading.Condition = threading.Condition()
+        self.order: itertools.count = itertools.count()
+        self.stopped: bool = False
+        self.thread: Optional[threading.Thread] = None
+
+    def schedule(self, delay: float, callback: Callable, *args) -> Timer:
+        timer: Timer = Timer(time.monotonic() + delay,
+                             next(self.order), callback, args)
+        with self.condition:
+            heapq.heappush(self.heap, timer)
+            # Only an earlier deadline than the one the thread sleeps for needs to wake it up
+            if self.heap[0] is timer:
+                self.condition.notify()
+        return timer
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    # Run the timers until `stop` is called, run in its own thread
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while True:
+                    if self.stopped:
+                        return
+                    while self.heap and self.heap[0].callback is None:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    delay: float = self.heap[0].deadline - time.monotonic()
+                    if delay <= 0:
+                        timer: Timer = heapq.heappop(self.heap)
+                        break
+                    self.condition.wait(delay)
+            callback: Optional[Callable] = timer.callback
+            if callback is None:
+                continue
+            try:
+                callback(*timer.args)
+            except Exception as e:
+                print(f"!! Timer callback {callback} failed: {e} !!")
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Stop the thread, waiting for a callback that is running to finish (unless called from a callback)
+    def stop(self) -> None:
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(5.0)
+
+
 # Functions
 # TODO: Validate sequence on the server side
 def message_to_datagram(type: MessageType, operation: OperationType, sequence_number: int, user: str, payload: str) -> bytes:
@@ -76,7 +471,7 @@ def message_to_datagram(type: MessageType, operation: OperationType, sequence_nu
     # Check the legths of string items
     if len(user) > 32:
         raise ValueError('User name must be 32 characters or less.')
-    if len(payload) > 2**32:
+    if len(payload) >= 2**32:
         raise ValueError(
             'Payload size must be less than 2^32 bytes (FFFF FFFF).')
 
@@ -92,12 +487,18 @@ def message_to_datagram(type: MessageType, operation: OperationType, sequence_nu
 
     # Check combined constraints
     if type == MessageType.CONTROL:
-        if operation not in [OperationType.ERR, OperationType.SYN, OperationType.ACK, OperationType.SYNACK, OperationType.FIN, OperationType.FINERR]:
+        if operation not in [OperationType.ERR, OperationType.SYN, OperationType.ACK, OperationType.SYNACK, OperationType.FIN, OperationType.FINERR, OperationType.ANNOUNCE, OperationType.KEEPALIVE, OperationType.KEEPALIVEACK]:
             raise ValueError(
-                'Control messages must have SYN, ACK, SYNACK or FIN operations.')
-        if operation not in [OperationType.ERR, OperationType.FINERR] and len(payload) > 0:
+                'Control messages must have SYN, ACK, SYNACK, FIN, ANNOUNCE or KEEPALIVE operations.')
+        # NOTE: ACKs may carry the receiver's advertised credit (free slots in its client buffer) as payload
+        # NOTE: SYN and SYNACK carry the public key of the key exchange as payload
+        if operation not in [OperationType.ERR, OperationType.FINERR, OperationType.ACK, OperationType.SYN, OperationType.SYNACK] and len(payload) > 0:
             raise ValueError(
                 'Non-error control messages must not have a payload.')
+        if operation == OperationType.ACK and len(payload) > 0 and not payload.isdigit():
+            raise ValueError('ACK payload must be the advertised credit.')
+        if operation in [OperationType.SYN, OperationType.SYNACK] and not all(c in '0123456789abcdef' for c in payload):
+            raise ValueError('SYN and SYNACK payload must be a hex public key.')
         if operation in [OperationType.ERR, OperationType.FINERR] and len(payload) == 0:
             raise ValueError('Error control messages must have a payload.')
     elif type == MessageType.CHAT:
@@ -106,27 +507,22 @@ def message_to_datagram(type: MessageType, operation: OperationType, sequence_nu
                 'Chat messages must have same `0x01` operation as ERR.')
         if len(payload) == 0:
             raise ValueError('Chat messages must have a payload.')
+    elif type == MessageType.GROUP:
+        # Group chat messages use the same `0x01` operation as chat messages, and are ACKed with group ACKs
+        if operation not in [OperationType.ERR, OperationType.ACK]:
+            raise ValueError(
+                'Group messages must have ERR (chat) or ACK operations.')
+        if operation == OperationType.ERR and len(payload) == 0:
+            raise ValueError('Group chat messages must have a payload.')
+        if operation == OperationType.ERR and (len(payload) <= GROUP_PREFIX_LENGTH + 1 or payload[GROUP_PREFIX_LENGTH] != ' ' or not all(c in '0123456789abcdef' for c in payload[:GROUP_PREFIX_LENGTH])):
+            raise ValueError(
+                'Group chat messages must start with the group id, the message number and a space.')
+        if operation == OperationType.ACK and len(payload) > 0 and not payload.isdigit():
+            raise ValueError('ACK payload must be the advertised credit.')
+    elif type == MessageType.SECURE:
+        # The payload of secure datagrams is binary, they are built by `SessionCipher.seal`
+        raise ValueError('Secure datagrams must be built with a SessionCipher.')
 
     # Return the datagram
     return bytes([type.value, operation.value, sequence_number]) + user.encode('ascii').ljust(32, b'\x00') + len(payload).to_bytes(4, 'big') + payload.encode('ascii')
 
-
-# Test
-# if __name__ == '__main__':
-    # Test the message_to_datagram function
-    # print('Testing message_to_datagram function...')
-    # print('Control message (SYN)')
-    # control_message = message_to_datagram(MessageType.CONTROL,
-    #                                       OperationType.SYN, 0x00, 'user1', '')
-    # print(control_message)
-    # print(Datagram(control_message))
-    # print('\nControl message (ERR)')
-    # error_message = message_to_datagram(MessageType.CONTROL,
-    #                                     OperationType.ERR, 0x00, 'user3', 'This is an error description')
-    # print(error_message)
-    # print(Datagram(error_message))
-    # print('\nChat message')
-    # chat_message = message_to_datagram(MessageType.CHAT,
-    #                                    OperationType.ERR, 0x00, 'user5', 'Hello, world!')
-    # print(chat_message)
-    # print(Datagram(chat_message))
@@ -4,7 +4,7 @@ import sys
 import queue
 import time
 import select
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
 
 class Client:
@@ -22,6 +22,7 @@ class Client:
         # Invitation and chat details
         self.invitation: bool = False
         self.chatting: bool = False
+        self.in_group: bool = False  # Whether the chat is a group chat we started
         self.chat_addr: Optional[str] = None
         self.chat_user: Optional[str] = None
 
@@ -47,7 +48,7 @@ class Client:
             else:
                 self.username = input("Please enter your username: ")
                 print("Welcome, ", self.username,
-                      " you may now connect to a user via their IP to chat or wait for somebody to connect to you.\n")
+                      " you may now connect to a user via their IP or username to chat or wait for somebody to connect to you.\n")
                 self.socket.sendall(self.username.encode('ascii'))
 
         # Start receiving responses in a new thread
@@ -97,16 +98,26 @@ class Client:
                     # Display the chat message
                     print(
                         f"\n\n<------\n{from_user}: {message_payload}\n<------")
-                elif "Chat connection established" in message:
+                elif message.startswith("GROUP"):
+                    _, from_user, message_payload = message.split(" ", 2)
+                    # Display the group chat message
+                    print(
+                        f"\n\n<------\n{from_user} (group): {message_payload}\n<------")
+                elif "was dropped" in message:
+                    # A member of our group timed out, the group chat goes on with the others
+                    print("\n" + message)
+                elif "Chat connection established" in message or "Group chat established" in message:
                     print("\n" + message)
                     self.chatting = True
+                    self.in_group = "Group chat established" in message
                     self.invitation = False
                     self.expecting_invitation_input = False
-                elif "invitation rejected" in message or "already in chat" in message or "No client is connected" in message or "ended the chat" in message or "timed out" in message:
+                elif "invitation rejected" in message or "already in chat" in message or "No client is connected" in message or "ended the chat" in message or "timed out" in message or "unknown user" in message or "group chat ended" in message:
                     print("\n" + message)
                     self.invitation = False
                     self.expecting_invitation_input = False
                     self.chatting = False
+                    self.in_group = False
                 else:
                     print("\nResponse from daemon:", message)
                 prompt_displayed = False  # Redisplay prompt
@@ -117,10 +128,12 @@ class Client:
                     prompt: str = "\nDo you accept the invitation? (Y/N): "
                 elif self.invitation:
                     prompt = ""
+                elif self.chatting and self.in_group:
+                    prompt = "\nEnter command (CHAT <message>, LEAVE, QUIT): "
                 elif self.chatting:
                     prompt = "\nEnter command (CHAT <message>, QUIT): "
                 else:
-                    prompt = "\nEnter command (CONNECT <ip>, QUIT): "
+                    prompt = "\nEnter command (CONNECT <ip|username>, GROUP <ip|username> ..., QUIT): "
                 print(prompt, end='', flush=True)
                 prompt_displayed = True
 
@@ -146,6 +159,8 @@ class Client:
                     if user_input.startswith("CHAT "):
                         _, message = user_input.split(" ", 1)
                         self.send_chat_message(message)
+                    elif user_input == "LEAVE" and self.in_group:
+                        self.send_command("LEAVE")
                     elif user_input == "QUIT":
                         self.quit_chat()
                         break
@@ -155,6 +170,8 @@ class Client:
                     if user_input.startswith("CONNECT "):
                         _, remote_ip = user_input.split(" ", 1)
                         self.connect_to_user(remote_ip)
+                    elif user_input.startswith("GROUP "):
+                        self.start_group(user_input.split(" ")[1:])
                     elif user_input == "QUIT":
                         self.quit_chat()
                         break
@@ -178,9 +195,9 @@ class Client:
             else:
                 print("Invalid input. Please enter 'Y' or 'N'.")
 
-    # Send an invitation to user with ip, through connection initiation message to the Daemon
+    # Send an invitation to user with ip (or username of a discovered user), through connection initiation message to the Daemon
     def connect_to_user(self, remote_ip: str) -> None:
-        if remote_ip == self.host:
+        if remote_ip == self.host or remote_ip == self.username:
             print("Cannot connect to self.")
             return
         print(f"\nWaiting for user at {remote_ip} to accept the invitation...")
@@ -190,6 +207,15 @@ class Client:
         # Set the invitation details
         self.invitation = True
 
+    # Start a group chat with the users at the given ips (or usernames of discovered users)
+    def start_group(self, members: List[str]) -> None:
+        members = [member for member in members if member]
+        if self.host in members or self.username in members:
+            print("Cannot start a group with self.")
+            return
+        print(f"\nStarting group chat with {', '.join(members)}...")
+        self.send_command("GROUP " + " ".join(members))
+
     # Send a message to the connected user through the Daemon
     def send_chat_message(self, message: str) -> None:
         print(f"\n------>\n{self.username}: {message}\n------>")
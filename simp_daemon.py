@@ -1,140 +1,772 @@
 import socket
 import threading
 import sys
+import os
 import time
 import random
-from typing import Optional, Tuple
+import queue
+import ipaddress
+import json
+import secrets
+import select
+import signal
+import tempfile
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
 
-from simp_classes import Datagram, MessageType, OperationType, message_to_datagram
+from simp_classes import GROUP_ID_LENGTH, GROUP_PREFIX_LENGTH, Datagram, KeyExchange, MessageType, OperationType, PeerCache, ReceiveCache, RetransmissionTimer, SessionCipher, Timer, TimerHeap, message_to_datagram
+
+# Environment variable with the path of the snapshot a restarted daemon resumes from
+SNAPSHOT_ENV: str = 'SIMP_SNAPSHOT'
+
+
+class GroupSession:
+    # A group chat: every chat message of our client is fanned out to all member daemons
+    # - each message is encoded once, for each sequence number only one header byte differs
+    # - every member runs its own stop-and-wait, so a lagging member never holds up the others
+    # - per member state is kept in a few bitmasks and lists indexed by member position
+    def __init__(self, daemon: "Daemon", members: List[Tuple[str, int]]) -> None:
+        self.daemon: Daemon = daemon
+        self.members: List[Tuple[str, int]] = members
+        self.member_index: Dict[Tuple[str, int], int] = {
+            addr: i for i, addr in enumerate(members)}
+        # Sent with every message, so members do not take a new group for retransmissions of our last one
+        self.group_id: str = secrets.token_hex(GROUP_ID_LENGTH // 2)
+        # Bit i of each mask belongs to member i
+        self.active: int = (1 << len(members)) - 1  # Members that did not time out
+        self.pending: int = 0  # Members with a message waiting for an ACK
+        self.sequence_bits: int = 0  # Sequence number of the current message of each member
+        # Messages not yet ACKed by every member, as (sequence number 0, sequence number 1) datagrams
+        self.log: List[Tuple[bytes, bytes]] = []
+        self.log_start: int = 0  # Message number of `log[0]`
+        self.next_message: List[int] = [0] * len(members)
+        self.sent_at: List[float] = [0.0] * len(members)
+        self.retries: List[int] = [0] * len(members)
+        # Last credit advertised by each member (None if it did not advertise any)
+        self.credits: List[Optional[int]] = [None] * len(members)
+        # Retransmission timer of each member's current message, on the daemon's shared timer heap
+        self.timers: List[Optional[Timer]] = [None] * len(members)
+        self.max_retries: int = 3
+        self.max_backlog: int = 64  # Members lagging further behind than this are dropped
+        self.retransmission_timer: RetransmissionTimer = RetransmissionTimer()
+        self.lock: threading.Lock = threading.Lock()
+        self.closed: bool = False
+
+    # Fan out one chat message to every member that is not still busy with an earlier one
+    def send(self, message: str) -> None:
+        with self.lock:
+            message_number: int = self.log_start + len(self.log)
+            datagram: bytes = message_to_datagram(
+                MessageType.GROUP, OperationType.ERR, 0x00, self.daemon.username, f"{self.group_id}{message_number:08x} {message}")
+            self.log.append((datagram, datagram[:2] + b'\x01' + datagram[3:]))
+            print(
+                f"\n----------->\nDAEMON: Sending group datagram to {bin(self.active).count('1')} members:\n{Datagram(datagram)}\n----------->\n")
+            for i in range(len(self.members)):
+                if not self.active >> i & 1:
+                    continue
+                if message_number - self.next_message[i] >= self.max_backlog:
+                    self.drop_member(i, "too far behind")
+                elif not self.pending >> i & 1 and self.next_message[i] == message_number:
+                    self.transmit(i)
+
+    # Send member `i` its current message and start its retransmission timer, must be called holding the lock
+    # - every member has its own exponential backoff
+    def transmit(self, i: int) -> None:
+        variants: Tuple[bytes, bytes] = self.log[self.next_message[i] -
+                                                 self.log_start]
+        datagram: bytes = variants[self.sequence_bits >> i & 1]
+        try:
+            self.daemon.daemon_socket.sendto(datagram, self.members[i])
+        except OSError as e:
+            print(f"!! Could not send group datagram to {self.members[i]}: {e} !!")
+        self.sent_at[i] = time.time()
+        self.pending |= 1 << i
+        self.cancel_timer(i)
+        self.timers[i] = self.daemon.timers.schedule(
+            self.retransmission_timer.rto * 2 ** self.retries[i], self.retransmit, i)
+
+    def cancel_timer(self, i: int) -> None:
+        timer: Optional[Timer] = self.timers[i]
+        if timer is not None:
+            timer.cancel()
+            self.timers[i] = None
+
+    def handle_ack(self, ack: Datagram, addr: Tuple[str, int]) -> None:
+        with self.lock:
+            i: Optional[int] = self.member_index.get(addr)
+            if i is None or not self.pending >> i & 1 or ack.header.sequence_number != self.sequence_bits >> i & 1:
+                return
+            # Only datagrams sent once give a reliable RTT sample (Karn's algorithm)
+            if self.retries[i] == 0:
+                self.retransmission_timer.on_rtt_sample(
+                    time.time() - self.sent_at[i])
+            self.credits[i] = int(
+                ack.payload.message) if ack.payload.message.isdigit() else None
+            self.pending &= ~(1 << i)
+            self.cancel_timer(i)
+            self.sequence_bits ^= 1 << i
+            self.retries[i] = 0
+            self.next_message[i] += 1
+            # Move on to the next message of this member, if it is already waiting
+            if self.next_message[i] < self.log_start + len(self.log):
+                self.transmit(i)
+            self.trim_log()
+
+    # Forget messages every active member has ACKed, must be called holding the lock
+    def trim_log(self) -> None:
+        active_positions: List[int] = [self.next_message[i] for i in range(
+            len(self.members)) if self.active >> i & 1]
+        oldest: int = min(active_positions, default=self.log_start + len(self.log))
+        del self.log[:oldest - self.log_start]
+        self.log_start = oldest
+
+    # Drop a member that timed out or lags too far behind, must be called holding the lock
+    def drop_member(self, i: int, reason: str) -> None:
+        self.active &= ~(1 << i)
+        self.pending &= ~(1 << i)
+        self.cancel_timer(i)
+        print(f"\n!! Dropping group member {self.members[i]}: {reason} !!\n")
+        self.daemon.send_to_client(
+            f"Group member at {self.members[i][0]} was dropped: {reason}.")
+        self.trim_log()
+        if not self.active and not self.closed:
+            self.closed = True
+            self.daemon.send_to_client(
+                "!! No members left, group chat ended. !!")
+
+    # The ACK of member `i` is overdue (run by the timer heap)
+    def retransmit(self, i: int) -> None:
+        with self.lock:
+            if self.closed or not self.pending >> i & 1:
+                return
+            self.timers[i] = None
+            # A member without credit drops our datagram on purpose, keep probing it without giving up
+            # (until it lags more than `max_backlog` messages behind)
+            if self.credits[i] == 0:
+                self.transmit(i)
+                return
+            self.retries[i] += 1
+            if self.retries[i] >= self.max_retries:
+                self.drop_member(i, "connection timed out")
+            else:
+                print(
+                    f"Timeout waiting for group ACK from {self.members[i]}. Retrying...")
+                self.transmit(i)
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+            for i in range(len(self.members)):
+                self.cancel_timer(i)
+
+    # JSON compatible state, for handing over to a restarted daemon (the timers are not part of it)
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            return {'members': [list(addr) for addr in self.members], 'group_id': self.group_id, 'active': self.active, 'pending': self.pending,
+                    'sequence_bits': self.sequence_bits, 'log': [[variant.hex() for variant in variants] for variants in self.log],
+                    'log_start': self.log_start, 'next_message': self.next_message, 'retries': self.retries, 'credits': self.credits,
+                    'retransmission_timer': self.retransmission_timer.to_dict(), 'closed': self.closed}
+
+    # Resume a group chat of the daemon we were restarted from, the messages still waiting for an ACK are sent again
+    @classmethod
+    def from_dict(cls, daemon: "Daemon", state: Dict[str, Any]) -> "GroupSession":
+        group_session: GroupSession = cls(
+            daemon, [(addr[0], addr[1]) for addr in state['members']])
+        with group_session.lock:
+            group_session.group_id = state['group_id']
+            group_session.active = state['active']
+            group_session.pending = state['pending']
+            group_session.sequence_bits = state['sequence_bits']
+            group_session.log = [(bytes.fromhex(first), bytes.fromhex(second))
+                                 for first, second in state['log']]
+            group_session.log_start = state['log_start']
+            group_session.next_message = state['next_message']
+            group_session.retries = state['retries']
+            group_session.credits = state['credits']
+            group_session.retransmission_timer = RetransmissionTimer.from_dict(
+                state['retransmission_timer'])
+            group_session.closed = state['closed']
+            if not group_session.closed:
+                for i in range(len(group_session.members)):
+                    if group_session.pending >> i & 1:
+                        group_session.transmit(i)
+        return group_session
 
 
 class Daemon:
-    def __init__(self, host: str) -> None:
+    # - `snapshot` is the state handed over by the daemon we were restarted from (see `hot_restart`),
+    #   including its sockets, which are already bound and listening
+    def __init__(self, host: str, discovery_peers: Optional[List[str]] = None, snapshot: Optional[Dict[str, Any]] = None) -> None:
         self.host: str = host
         self.username: Optional[str] = None
         # Used for surpressing the "Daemon listener thread shutdown." message for the first time
         self.has_been_connected: bool = False
+        inherited_fds: Dict[str, int] = snapshot['fds'] if snapshot else {}
 
         # Create a UDP socket - for DAEMON to DAEMON communication
-        self.daemon_socket: socket.socket = socket.socket(
-            socket.AF_INET, socket.SOCK_DGRAM)
-        self.daemon_socket.bind((self.host, 7777))
+        if 'daemon' in inherited_fds:
+            self.daemon_socket: socket.socket = self.inherit_socket(
+                inherited_fds['daemon'])
+        else:
+            self.daemon_socket = socket.socket(
+                socket.AF_INET, socket.SOCK_DGRAM)
+            self.daemon_socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            self.daemon_socket.bind((self.host, 7777))
         self.send_sequence_number: int = 0x00  # For sending datagrams
         self.expected_sequence_number: int = 0x00  # For receiving datagrams
+        # Recently accepted datagrams and their ACKs, for answering retransmissions when an ACK got lost
+        self.receive_cache: ReceiveCache = ReceiveCache()
 
         # TCP socket and details for DAEMON to CLIENT conenction
-        self.client_socket: socket.socket = socket.socket(
-            socket.AF_INET, socket.SOCK_STREAM)
+        if 'client_listener' in inherited_fds:
+            self.client_socket: socket.socket = self.inherit_socket(
+                inherited_fds['client_listener'])
+        else:
+            self.client_socket = socket.socket(
+                socket.AF_INET, socket.SOCK_STREAM)
+            # Connections of a previous run lingering in TIME_WAIT must not keep a cold restart from binding
+            self.client_socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Start listening for client connections
+            self.client_socket.bind((self.host, 7778))
+            self.client_socket.listen()
         self.client_conn: Optional[socket.socket] = None
         self.client_is_connected: bool = False
         self.client_lock: threading.Lock = threading.Lock()
-        # Start listening for client connections
-        self.client_socket.bind((self.host, 7778))
-        self.client_socket.listen()
+        # Everything for the client goes through this queue and is written by a separate thread,
+        # so a slow client never blocks the daemon listener
+        # - at most `client_buffer_size` chat messages are buffered, the free slots are advertised to the peer in every ACK
+        self.client_buffer_size: int = 32
+        self.client_queue: queue.Queue[Optional[str]] = queue.Queue()
+        self.client_writer_thread: Optional[threading.Thread] = None
+        # The connection of a client handed over by the daemon we were restarted from, served once the client listener starts
+        self.resumed_client: Optional[socket.socket] = None
 
         # Invitation related
         self.pending_invitation: bool = False
         self.inviting_user: Optional[str] = None
         self.inviting_addr: Optional[str] = None
+        self.inviting_sequence_number: int = 0x00
 
         # Chat related
         self.remote_addr: Optional[Tuple[str, int]] = None
         self.is_in_chat: bool = False
+        # Group chat started by our client, if any (receiving group messages needs no session)
+        self.group_session: Optional[GroupSession] = None
+        # Group chats we are a member of: sender address -> (group id, number of the next message)
+        self.group_senders: Dict[Tuple[str, int], Tuple[str, int]] = {}
 
         # NEW: Flag for `send_with_retrnasmission` race condition
+        # - these only describe sends waiting for the listener to receive their ACK, a send from within the listener
+        #   receives its ACK itself and keeps its state to itself, so it can never take over another send's wait
         self.pending_ack: bool = False
         self.pending_ack_lock: threading.Lock = threading.Lock()
+        # Where the ACK we are waiting for comes from, and whether it is from a third party (which must not toggle the sequence numbers)
+        self.pending_ack_addr: Optional[Tuple[str, int]] = None
+        self.pending_ack_skip_sequence_check: bool = False
+        # Signalled by the listener thread when the ACK we are waiting for has arrived
+        self.ack_condition: threading.Condition = threading.Condition(
+            self.pending_ack_lock)
+        # Only one thread may receive from the daemon socket, the listener (or a send from within the listener)
+        self.listener_thread_id: Optional[int] = None
+        # Datagrams received by a send from within the listener, that the listener handles once the send is done
+        self.deferred_datagrams: deque[Tuple[Datagram, Tuple[str, int], bool]] = deque()
+        # The chance of a datagram "dropping" (not being sent), to simulate packet loss
+        self.drop_probability: float = 0.2
+
+        # Flow and congestion control for sending
+        # - `peer_credit` is the last credit advertised by the remote daemon (None if it did not advertise any)
+        # - the retransmission timeout adapts to the measured RTT and backs off on loss
+        self.peer_credit: Optional[int] = None
+        self.retransmission_timer: RetransmissionTimer = RetransmissionTimer()
+        self.max_retries: int = 3  # Timeouts before the peer is considered gone
+        self.persist_timeout: float = 60.0  # seconds we keep probing a peer whose client is backed up
+        self.last_send_time: float = 0.0
+        self.transmissions: int = 0  # How many times the datagram waiting for an ACK has been sent
+
+        # Encryption, every chat gets its own keys from a Diffie-Hellman exchange in the handshake
+        # - `key_exchange` is our half of the exchange while our SYN waits for a SYNACK
+        # - `sessions` holds the cipher of each peer, after the chat ended it is kept for `session_linger` seconds,
+        #   so retransmissions of the last datagrams can still be answered
+        self.key_exchange: Optional[KeyExchange] = None
+        self.inviting_public_key: str = ""
+        self.sessions: Dict[Tuple[str, int], SessionCipher] = {}
+        self.session_linger: float = 30.0
+
+        # All timers of the daemon (keepalives, group retransmissions, announcements, ...) run on this one heap
+        self.timers: TimerHeap = TimerHeap()
+        self.timers.start()
+
+        # Keepalive, so that a chat partner that disappeared is noticed even if the chat is idle
+        # - after `keepalive_interval` seconds without hearing from the peer a KEEPALIVE is sent, every
+        #   `keepalive_probe_interval` seconds, and after `keepalive_probes` unanswered ones the peer is considered dead
+        # - so a dead peer is detected at most `keepalive_interval + keepalive_probes * keepalive_probe_interval` seconds
+        #   after it was last heard from
+        # - incoming datagrams only update `last_heard`, the single timer of the chat checks it when it fires
+        self.keepalive_interval: float = 15.0
+        self.keepalive_probe_interval: float = 2.0
+        self.keepalive_probes: int = 3
+        self.last_heard: float = 0.0
+        self.keepalive_probes_sent: int = 0
+        self.keepalive_timer: Optional[Timer] = None
+
+        # Peer discovery, so that `CONNECT <username>` works without knowing the IP
+        # - while a client is connected we periodically ANNOUNCE its username to `discovery_targets`
+        # - announcements of other daemons fill `peer_cache`
+        # - by default announcements are broadcast, `discovery_peers` can list daemons (IPs) to announce to instead
+        # - the daemon socket is bound to our unicast address, which never receives broadcasts, so they are received
+        #   on `discovery_socket`, bound to the broadcast address (shared with the other daemons of this host)
+        self.peer_cache: PeerCache = PeerCache()
+        self.announce_interval: float = 5.0  # seconds
+        self.discovery_targets: List[Tuple[str, int]] = [
+            (peer, 7777) for peer in (discovery_peers or ['<broadcast>'])]
+        self.discovery_socket: Optional[socket.socket] = None
+        if ('<broadcast>', 7777) in self.discovery_targets:
+            self.discovery_socket = socket.socket(
+                socket.AF_INET, socket.SOCK_DGRAM)
+            self.discovery_socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                self.discovery_socket.bind(('<broadcast>', 7777))
+            except OSError as e:
+                print(
+                    f"!! Could not listen for broadcast announcements, only peers we announce to will answer: {e} !!")
+                self.discovery_socket.close()
+                self.discovery_socket = None
+
+        # Graceful shutdown and hot restart
+        # - while `draining` no new client commands or connections are taken, the one being handled finishes
+        #   (`command_lock` is held while a command is handled)
+        # - the listener stops once `listener_stop` is set, and sets `listener_stopped` when it did
+        #   (datagrams deferred by its last send are left for the restarted daemon)
+        # - whatever arrives meanwhile stays unread in the sockets, for the restarted daemon
+        self.draining: bool = False
+        self.command_lock: threading.Lock = threading.Lock()
+        self.listener_stop: threading.Event = threading.Event()
+        self.listener_stopped: threading.Event = threading.Event()
+        if snapshot:
+            self.restore(snapshot)
 
     # Send a datagram and wait for an ACK of the message
     def send_with_retransmission(self, datagram: bytes, addr: Tuple[str, int], skip_sequence_check: bool = False) -> bool:
-        max_retries: int = 3
-        timeout: int = 5  # seconds
         retries: int = 0
-        drop_probability: float = 0.2
         sequence_number: int = Datagram(datagram).header.sequence_number
+        # Flow control only applies to the chat partner, not to third parties we are rejecting
+        is_chat_partner: bool = not skip_sequence_check and addr == self.remote_addr
+        persist_start: Optional[float] = None
+        # Whether we are the listener, which can't wait for itself to receive the ACK
+        inline: bool = threading.get_ident() == self.listener_thread_id
 
         # NEW: Set the pending ACK flag to true
-        with self.pending_ack_lock:
-            self.pending_ack = True
+        if not inline:
+            with self.pending_ack_lock:
+                self.pending_ack = True
+                self.pending_ack_addr = addr
+                self.pending_ack_skip_sequence_check = skip_sequence_check
+
+        # The remote client is backed up, give it some time to drain before sending anything new
+        if is_chat_partner and self.peer_credit == 0:
+            print(
+                f"\n** Remote daemon advertised no credit, waiting {self.retransmission_timer.rto:.2f}s before sending. **\n")
+            time.sleep(self.retransmission_timer.rto)
 
-        while retries < max_retries:
+        if not inline:
+            self.transmissions = 0
+        while retries < self.max_retries:
             # Simulate packet loss
-            if random.random() > drop_probability:
-                self.daemon_socket.sendto(datagram, addr)
+            if random.random() > self.drop_probability:
+                self.send_datagram(datagram, addr)
+            if not inline:
+                self.transmissions += 1
+                self.last_send_time = time.time()
             print(
                 f"\n----------->\nDAEMON (Attempt #{retries + 1}): Sending datagram {addr}:\n{Datagram(datagram)}\n----------->\n")
-            start_time: float = time.time()
-            self.daemon_socket.settimeout(timeout)
-            try:
-                while True:
-                    time_elapsed: float = time.time() - start_time
-                    if time_elapsed > timeout:
-                        raise socket.timeout
-                    # TODO: Is this enough to skip?
-                    # If inside when waiting for an ACK we find that the pending_ack flag is false
-                    # - this means that the ACK was received and handled by handle datagram
-                    with self.pending_ack_lock:
-                        if not self.pending_ack:
-                            return True
-                    response, _ = self.daemon_socket.recvfrom(1024)
-                    ack = Datagram(response)
+            if self.wait_for_ack(sequence_number, addr, skip_sequence_check, self.retransmission_timer.rto, is_chat_partner):
+                return True  # Message was successfully sent, and correct ACK received
+            # The chat was dropped meanwhile (e.g. ended by the peer or by the keepalive), nothing left to send it for
+            if is_chat_partner and self.remote_addr != addr:
+                with self.pending_ack_lock:
+                    self.pending_ack = False
+                print(f"\n** Chat with {addr} ended, giving up on the datagram. **\n")
+                return False
+            self.retransmission_timer.on_timeout()
+            # A receiver without credit drops our datagram on purpose, so keep probing it without giving up,
+            # as long as it does not take longer than `persist_timeout`
+            if is_chat_partner and self.peer_credit == 0:
+                if persist_start is None:
+                    persist_start = time.time()
+                if time.time() - persist_start < self.persist_timeout:
                     print(
-                        f"\n<-----------\nDAEMON: Received datagram (in retransmit) from {addr}:\n{ack}\n<-----------\n")
-                    # If the ACK is coming from a third party being rejected, skip the sequence number check and switch
-                    if ack.header.operation == OperationType.ACK and skip_sequence_check:
-                        return True
-                    # Handle sequence number validation and switch sequence numbers
-                    if (ack.header.operation == OperationType.ACK and ack.header.sequence_number == sequence_number):
-                        self.send_sequence_number = 0x01 if self.send_sequence_number == 0x00 else 0x00
-                        self.expected_sequence_number = 0x01 if self.expected_sequence_number == 0x00 else 0x00
-                        # NEW: Set the pending ACK flag to false
-                        with self.pending_ack_lock:
-                            self.pending_ack = False
-                        self.daemon_socket.settimeout(None)
-                        return True  # Message was successfully sent, and correct ACK received
-            except socket.timeout:
-                retries += 1
-                print(f"Timeout waiting for ACK. Retrying...")
-                continue
+                        f"Remote client is backed up, probing again in {self.retransmission_timer.rto:.2f}s...")
+                    continue
+            retries += 1
+            print(f"Timeout waiting for ACK. Retrying...")
 
-        self.daemon_socket.settimeout(None)
-        print(f"Failed to receive ACK after {max_retries} attempts.")
+        if not inline:
+            with self.pending_ack_lock:
+                self.pending_ack = False
+        print(f"Failed to receive ACK after {self.max_retries} attempts.")
+        # A third party not answering does not affect our own chat
+        if skip_sequence_check:
+            return False
         # Handle timeout
         #  - Send FINERR to the other user
         #  - Inform the client
         print(
-            f"\n** Connection timed out, sending FINERR to {self.inviting_addr} **\n")
-
-        # Send FINERR to the remote daemon - trying to end the chat for them too
-        err_payload: str = "Connection timed out, exiting chat... :("
-        reply: bytes = message_to_datagram(
-            MessageType.CONTROL, OperationType.FINERR, self.send_sequence_number, self.username, err_payload)
-        if self.inviting_addr:
-            self.send_with_retransmission(reply, self.inviting_addr)
-            print(f"\n**Sent FINERR to {self.inviting_addr}**\n")
-        else:
-            self.send_with_retransmission(reply, self.remote_addr)
-            print(f"\n**Sent FINERR to {self.remote_addr}**\n")
+            f"\n** Connection timed out, sending FINERR to {addr} **\n")
+
+        self.drop_chat(addr, "Connection timed out, exiting chat... :(")
+        return False
 
-        # Inform the client and reset the chat details
+    # Give up on a peer that stopped answering
+    # - both the keepalive (timer thread) and a send that timed out may notice, only the first one drops the chat
+    def drop_chat(self, addr: Tuple[str, int], reason: str) -> None:
+        with self.pending_ack_lock:
+            if addr != self.remote_addr and addr != self.inviting_addr:
+                return
+            # Send FINERR to the remote daemon - trying to end the chat for them too
+            # - only once, as the peer is most likely gone, retransmitting (and timing out again) would never end
+            reply: bytes = message_to_datagram(
+                MessageType.CONTROL, OperationType.FINERR, self.send_sequence_number, self.username, reason)
+            self.send_datagram(reply, addr)
+            print(f"\n**Sent FINERR to {addr}**\n")
+            # Nothing of the peer is needed anymore, not even for retransmissions
+            self.sessions.pop(addr, None)
+            self.receive_cache.forget(addr)
+            self.stop_keepalive()
+
+            # Inform the client and reset the chat details
+            self.reset_chat()
+            self.pending_invitation = False
+            self.inviting_addr = None
+            self.inviting_user = None
+            self.send_to_client(reason)
+
+    # Reset the chat details once the chat ended (or could not be established), must be called holding `pending_ack_lock`
+    # - the chat state is shared by the client's thread, the listener and the timers, it only changes holding the lock
+    # - a send still waiting for an ACK of the chat is woken up, so that it gives up
+    def reset_chat(self) -> None:
         self.is_in_chat = False
         self.remote_addr = None
+        self.peer_credit = None
         # Reset sequence numbers
         self.send_sequence_number = 0x00
         self.expected_sequence_number = 0x00
-        self.client_conn.sendall(
-            "Connection timed out, exiting chat... :(".encode('ascii'))
+        self.ack_condition.notify_all()
+
+    # Wait until the ACK of the datagram we sent arrives, returns False on timeout
+    def wait_for_ack(self, sequence_number: int, addr: Tuple[str, int], skip_sequence_check: bool, timeout: float, is_chat_partner: bool = False) -> bool:
+        # Normally the listener thread receives the ACK (in `handle_datagram`) and wakes us up right away
+        # (and `reset_chat` does, if the chat we are sending for ends)
+        if threading.get_ident() != self.listener_thread_id:
+            with self.ack_condition:
+                self.ack_condition.wait_for(
+                    lambda: not self.pending_ack or (is_chat_partner and self.remote_addr != addr), timeout)
+                return not self.pending_ack
+
+        # When sending from the listener thread itself (e.g. rejecting a SYN), we have to receive the ACK here
+        # - everything else is put aside, and handled by the listener once we are done
+        start_time: float = time.time()
+        try:
+            while True:
+                time_left: float = timeout - (time.time() - start_time)
+                if time_left <= 0:
+                    return False
+                self.daemon_socket.settimeout(time_left)
+                try:
+                    response, response_addr = self.daemon_socket.recvfrom(
+                        65535)
+                    ack, authenticated = self.open_datagram(
+                        response, response_addr)
+                except socket.timeout:
+                    return False
+                except ValueError as e:
+                    print(f"\n!! Dropping invalid datagram: {e} !!\n")
+                    continue
+                print(
+                    f"\n<-----------\nDAEMON: Received datagram (in retransmit) from {response_addr}:\n{ack}\n<-----------\n")
+                # If the ACK is coming from a third party being rejected, skip the sequence number check and switch
+                # - `pending_ack` belongs to a send of another thread (e.g. a chat message waiting for the
+                #   partner's ACK, which is deferred meanwhile), so it is left alone
+                if ack.header.operation == OperationType.ACK and response_addr == addr and (skip_sequence_check or ack.header.sequence_number == sequence_number) and (authenticated or not self.has_active_session(addr)):
+                    if not skip_sequence_check:
+                        with self.ack_condition:
+                            # Handle sequence number validation and switch sequence numbers
+                            self.send_sequence_number = 0x01 if self.send_sequence_number == 0x00 else 0x00
+                            self.expected_sequence_number = 0x01 if self.expected_sequence_number == 0x00 else 0x00
+                    return True
+                self.deferred_datagrams.append(
+                    (ack, response_addr, authenticated))
+        finally:
+            self.daemon_socket.settimeout(1.0)
+
+    # Update the flow and congestion control state from an ACK of our datagram
+    def handle_ack_credit_and_rtt(self, ack: Datagram) -> None:
+        # Only datagrams sent once give a reliable RTT sample (Karn's algorithm)
+        if self.transmissions == 1:
+            self.retransmission_timer.on_rtt_sample(
+                time.time() - self.last_send_time)
+        # Daemons not advertising credit are not flow controlled
+        if ack.payload.message.isdigit():
+            self.peer_credit = int(ack.payload.message)
+        else:
+            self.peer_credit = None
+
+    # Free chat message slots in the client buffer, advertised to the peer in every ACK
+    def receive_credit(self) -> int:
+        return max(self.client_buffer_size - self.client_queue.qsize(), 0)
+
+    # Queue a message for the client, it is written to the TCP connection by `client_writer`
+    def send_to_client(self, message: str) -> None:
+        self.client_queue.put(message)
+
+    # Write queued messages to the client until `None` is queued, run in its own thread per client connection
+    def client_writer(self, conn: socket.socket, client_queue: queue.Queue[Optional[str]]) -> None:
+        while True:
+            message: Optional[str] = client_queue.get()
+            if message is None:
+                break
+            try:
+                conn.sendall(message.encode('ascii'))
+            except OSError:
+                break
 
-    # Abstraction for sending an ACK
-    def send_ack(self, addr: Tuple[str, int], received_sequence_number: int) -> None:
+    # Abstraction for sending an ACK, returns the sent ACK so that it can be cached
+    def send_ack(self, addr: Tuple[str, int], received_sequence_number: int, reserved_credit: int = 0) -> bytes:
         reply_ack: bytes = message_to_datagram(
-            MessageType.CONTROL, OperationType.ACK, received_sequence_number, self.username, "")  # Expected sequence number is the same as the received sequence number
-        self.daemon_socket.sendto(reply_ack, addr)
+            MessageType.CONTROL, OperationType.ACK, received_sequence_number, self.username, str(max(self.receive_credit() - reserved_credit, 0)))  # Expected sequence number is the same as the received sequence number
+        self.send_datagram(reply_ack, addr)
         print(
             f"\n----------->\nDAEMON: Sending ACK {addr}:\n{Datagram(reply_ack)}\n----------->\n")
+        return reply_ack
+
+    # A cached ACK, rebuilt with the credit we have now, as the one it was sent with may be out of date
+    # (e.g. a stale 0 would send the peer into persist probing after our client caught up)
+    def refresh_ack(self, cached_ack: bytes) -> bytes:
+        return message_to_datagram(MessageType(cached_ack[0]), OperationType.ACK, cached_ack[2], self.username, str(self.receive_credit()))
+
+    # ACK a datagram and remember it, so that a retransmission of it is answered without processing it again
+    def accept_datagram(self, message_received: Datagram, addr: Tuple[str, int], reserved_credit: int = 0) -> None:
+        reply_ack: bytes = self.send_ack(
+            addr, message_received.header.sequence_number, reserved_credit)
+        self.receive_cache.store(addr, message_received.bytes, reply_ack)
+
+    # Send a datagram to another daemon, sealed with the keys of our session with it (if there is one)
+    # - SYN and SYNACK start a new session and ANNOUNCE is for everyone, so these always go in cleartext
+    def send_datagram(self, datagram: bytes, addr: Tuple[str, int]) -> None:
+        session: Optional[SessionCipher] = self.get_session(addr)
+        if session is not None and not (datagram[0] == MessageType.CONTROL.value and datagram[1] in [OperationType.SYN.value, OperationType.SYNACK.value, OperationType.ANNOUNCE.value]):
+            datagram = session.seal(datagram)
+        self.daemon_socket.sendto(datagram, addr)
+
+    # Parse a received datagram, unwrapping it if it is sealed, returns the datagram and whether it was sealed
+    # - raises a ValueError for anything malformed, forged, tampered with or replayed
+    def open_datagram(self, data: bytes, addr: Tuple[str, int]) -> Tuple[Datagram, bool]:
+        datagram: Datagram = Datagram(data)
+        if datagram.header.message_type != MessageType.SECURE:
+            return datagram, False
+        session: Optional[SessionCipher] = self.get_session(addr)
+        if session is None:
+            raise ValueError('Secure datagram without a session.')
+        inner: Datagram = Datagram(session.open(data))
+        if inner.header.message_type == MessageType.SECURE:
+            raise ValueError('Secure datagram inside a secure datagram.')
+        return inner, True
+
+    # The cipher of the session with a peer, ended sessions are forgotten once they stopped lingering
+    def get_session(self, addr: Tuple[str, int]) -> Optional[SessionCipher]:
+        session: Optional[SessionCipher] = self.sessions.get(addr)
+        if session is not None and session.expires_at is not None and session.expires_at < time.time():
+            del self.sessions[addr]
+            return None
+        return session
+
+    # Whether a chat with this peer is running, in which case only sealed datagrams from it are trusted
+    def has_active_session(self, addr: Tuple[str, int]) -> bool:
+        session: Optional[SessionCipher] = self.sessions.get(addr)
+        return session is not None and session.expires_at is None
+
+    def start_session(self, addr: Tuple[str, int], session: SessionCipher) -> None:
+        self.sessions[addr] = session
+
+    def end_session(self, addr: Tuple[str, int]) -> None:
+        session: Optional[SessionCipher] = self.sessions.get(addr)
+        if session is not None and session.expires_at is None:
+            session.expires_at = time.time() + self.session_linger
+            self.timers.schedule(self.session_linger,
+                                 self.evict_session, addr, session)
+        self.stop_keepalive()
+
+    # Forget the keys of an ended session once it stopped lingering (run by the timer heap)
+    def evict_session(self, addr: Tuple[str, int], session: SessionCipher) -> None:
+        if self.sessions.get(addr) is session:
+            del self.sessions[addr]
+
+    # Start watching the chat partner, called once the chat is established
+    def start_keepalive(self) -> None:
+        self.stop_keepalive()
+        self.last_heard = time.time()
+        self.keepalive_probes_sent = 0
+        self.keepalive_timer = self.timers.schedule(
+            self.keepalive_interval, self.check_keepalive)
+
+    def stop_keepalive(self) -> None:
+        if self.keepalive_timer is not None:
+            self.keepalive_timer.cancel()
+            self.keepalive_timer = None
+
+    # Probe the chat partner if it has been quiet for too long, or drop it if it stopped answering (run by the timer heap)
+    def check_keepalive(self) -> None:
+        addr: Optional[Tuple[str, int]] = self.remote_addr
+        if not self.is_in_chat or addr is None:
+            self.keepalive_timer = None
+            return
+        idle: float = time.time() - self.last_heard
+        if idle < self.keepalive_interval:
+            # Heard from the peer in the meantime, sleep until it could have become idle
+            self.keepalive_probes_sent = 0
+            self.keepalive_timer = self.timers.schedule(
+                self.keepalive_interval - idle, self.check_keepalive)
+            return
+        # A datagram waiting for its ACK is retransmitted anyway, which probes the peer already (and gives up on it
+        # if it is gone), so the keepalive waits until the send is done
+        with self.pending_ack_lock:
+            sending: bool = self.pending_ack and self.pending_ack_addr == addr
+        if sending:
+            self.keepalive_probes_sent = 0
+            self.keepalive_timer = self.timers.schedule(
+                self.keepalive_interval, self.check_keepalive)
+            return
+        if self.keepalive_probes_sent >= self.keepalive_probes:
+            print(
+                f"\n!! No answer from {addr} for {idle:.1f}s, dropping the chat. !!\n")
+            self.keepalive_timer = None
+            self.drop_chat(
+                addr, "Connection timed out, peer stopped responding... :(")
+            return
+        self.keepalive_probes_sent += 1
+        self.send_datagram(message_to_datagram(
+            MessageType.CONTROL, OperationType.KEEPALIVE, 0x00, self.username, ""), addr)
+        self.keepalive_timer = self.timers.schedule(
+            self.keepalive_probe_interval, self.check_keepalive)
+
+    # Announce our client's username to a peer (ANNOUNCE is never ACKed, as it is repeated anyway)
+    def send_announce(self, addr: Tuple[str, int]) -> None:
+        datagram: bytes = message_to_datagram(
+            MessageType.CONTROL, OperationType.ANNOUNCE, 0x00, self.username, "")
+        try:
+            self.daemon_socket.sendto(datagram, addr)
+        except OSError as e:
+            print(f"!! Could not send announcement to {addr}: {e} !!")
+
+    # Remember the user announced by another daemon (received on the daemon socket, or the discovery socket if broadcast)
+    def handle_announce(self, message_received: Datagram, addr: Tuple[str, int]) -> None:
+        if addr == (self.host, 7777) or not message_received.header.user:
+            return
+        if self.peer_cache.store(message_received.header.user, addr):
+            print(
+                f"\n** Discovered user {message_received.header.user} at {addr} **\n")
+            # Answer a new peer directly, so it does not have to wait for our next announcement
+            if self.client_is_connected and self.username:
+                self.send_announce(addr)
+
+    # Resolve the target of `CONNECT <target>`, which is either an IP or the username of a discovered peer
+    def resolve_peer(self, target: str) -> Optional[Tuple[str, int]]:
+        try:
+            ipaddress.ip_address(target)
+            return (target, 7777)
+        except ValueError:
+            return self.peer_cache.resolve(target)
+
+    # Whether our client is in a group chat it started (a group whose members were all dropped has ended)
+    def in_group_chat(self) -> bool:
+        return self.group_session is not None and not self.group_session.closed
+
+    # Handle a group chat message from a group sender, or an ACK from a member of our group
+    def handle_group_datagram(self, message_received: Datagram, addr: Tuple[str, int]) -> None:
+        if message_received.header.operation == OperationType.ACK:
+            if self.group_session:
+                self.group_session.handle_ack(message_received, addr)
+            return
+        payload: str = message_received.payload.message
+        group_id: str = payload[:GROUP_ID_LENGTH]
+        message_number: int = int(payload[GROUP_ID_LENGTH:GROUP_PREFIX_LENGTH], 16)
+        sequence_number: int = message_received.header.sequence_number
+        # Within a group, a message before the expected one is a retransmission (that ACK was lost or late),
+        # while the first message of a new group is always accepted
+        expected: Optional[Tuple[str, int]] = self.group_senders.get(addr)
+        if expected is not None and expected[0] == group_id and message_number < expected[1]:
+            reply_ack: bytes = message_to_datagram(
+                MessageType.GROUP, OperationType.ACK, sequence_number, self.username, str(self.receive_credit()))
+            self.daemon_socket.sendto(reply_ack, addr)
+            print(
+                f"\n** Duplicate group datagram from {addr}, re-sending ACK. **\n")
+            return
+        if not self.client_is_connected:
+            print(
+                f"\n!! Dropping group message from {addr}, no client is connected. !!\n")
+            return
+        if self.client_queue.qsize() >= self.client_buffer_size:
+            print(
+                f"\n!! Client buffer full, dropping group message from {addr} until the client catches up. !!\n")
+            return
+        self.send_to_client(
+            "GROUP " + message_received.header.user + " " + payload[GROUP_PREFIX_LENGTH + 1:])
+        self.group_senders[addr] = (group_id, message_number + 1)
+        reply_ack = message_to_datagram(
+            MessageType.GROUP, OperationType.ACK, sequence_number, self.username, str(self.receive_credit()))
+        self.daemon_socket.sendto(reply_ack, addr)
 
     # Handle an incoming datagram
-    def handle_datagram(self, message_received: Datagram, addr: Tuple[str, int]) -> None:
+    def handle_datagram(self, message_received: Datagram, addr: Tuple[str, int], authenticated: bool = False) -> None:
+        # Peer discovery announcements are outside of any chat, so they bypass the sequence number checks
+        if message_received.header.operation == OperationType.ANNOUNCE:
+            self.handle_announce(message_received, addr)
+            return
+        # Group chat datagrams have their own sequence numbers, independent of the one-to-one chat
+        if message_received.header.message_type == MessageType.GROUP:
+            self.handle_group_datagram(message_received, addr)
+            return
+
+        # Duplicate of a datagram we already accepted, meaning our ACK got lost and the peer retransmitted
+        # - answer it again with the cached ACK, but never process it (or deliver it to the client) twice
+        # - inside a chat an identical datagram with the expected sequence number is a new message (e.g. "hi" twice)
+        cached_ack: Optional[bytes] = self.receive_cache.lookup(
+            addr, message_received.bytes)
+        in_chat_with_peer: bool = self.is_in_chat and self.remote_addr == addr
+        if cached_ack is not None and (message_received.header.sequence_number != self.expected_sequence_number or not in_chat_with_peer):
+            reply_ack: bytes = self.refresh_ack(cached_ack)
+            self.send_datagram(reply_ack, addr)
+            print(
+                f"\n----------->\nDAEMON: Duplicate datagram, re-sending ACK {addr}:\n{Datagram(reply_ack)}\n----------->\n")
+            return
+
+        # Inside a session only sealed datagrams are trusted, as anyone can send a datagram from the peer's address
+        # (a re-sent ACK above changes nothing, so that one is fine)
+        if not authenticated and self.has_active_session(addr):
+            print(
+                f"\n!! Dropping unsealed {message_received.header.operation.name} datagram from {addr}, a session with it is running. !!\n")
+            return
+        # In a chat only the partner may act on it, and only with sealed datagrams (anyone can send from any address,
+        # and with a user of their choosing), everyone else can at most invite us and is told that we are busy
+        if self.is_in_chat and message_received.header.operation != OperationType.SYN and (addr != self.remote_addr or not authenticated):
+            print(
+                f"\n!! Dropping {'unsealed ' if not authenticated else ''}{message_received.header.operation.name} datagram from {addr}, we are in a chat with {self.remote_addr}. !!\n")
+            return
+        # Anything sealed by the chat partner shows it is still alive
+        if authenticated and addr == self.remote_addr:
+            self.last_heard = time.time()
+
+        # Keepalives are outside of the stop-and-wait exchange, so they bypass the sequence number checks
+        if message_received.header.operation == OperationType.KEEPALIVE:
+            if authenticated and self.is_in_chat and addr == self.remote_addr:
+                self.send_datagram(message_to_datagram(
+                    MessageType.CONTROL, OperationType.KEEPALIVEACK, 0x00, self.username, ""), addr)
+            return
+        if message_received.header.operation == OperationType.KEEPALIVEACK:
+            return
+
         # Validating the sequence number
         received_sequence_number: int = message_received.header.sequence_number
         # SYN messages are not validated to be of the expected sequence number as third party would not know the current sequence number
@@ -149,9 +781,21 @@ class Daemon:
         if message_received.header.message_type == MessageType.CONTROL:
             # SYN: Other client wants to start a chat
             if message_received.header.operation == OperationType.SYN:
+                # The SYN carries the inviting daemon's half of the key exchange
+                try:
+                    KeyExchange.parse_public_key(
+                        message_received.payload.message)
+                except ValueError as e:
+                    reply_fin = message_to_datagram(
+                        MessageType.CONTROL, OperationType.FINERR, message_received.header.sequence_number, "DAEMON", f"Key exchange failed, {e}")
+                    self.send_with_retransmission(
+                        reply_fin, addr, skip_sequence_check=True)
+                    print(
+                        f"!! Sent FINERR to {addr} trying to connect because of an invalid public key. !!\n")
+                    return
                 # Check if user is already in a chat
                 # If not, "establish channel" and send SYNACK
-                if not self.is_in_chat and not self.pending_invitation:
+                if not self.is_in_chat and not self.pending_invitation and not self.in_group_chat():
                     # Additionally check that there is connected client, if not send FINERR and decline chat
                     if not self.client_is_connected:
                         reply_fin: bytes = message_to_datagram(
@@ -163,26 +807,23 @@ class Daemon:
                         return
                     # Notify the user that another user wants to start a chat with them
                     invitation_message: str = f"CONNECT User {message_received.header.user} wants to start a chat."
-                    self.client_conn.sendall(
-                        invitation_message.encode('ascii'))
+                    self.send_to_client(invitation_message)
                     print(
                         f"\nReceived an invitation, forwarding to client: {invitation_message}\n")
-                    # Set the invitation details
+                    # Set the invitation details, anything cached from an earlier chat with this peer is stale now
+                    self.receive_cache.forget(addr)
                     self.pending_invitation = True
                     self.inviting_user = message_received.header.user
                     self.inviting_addr = addr
 
-                    # Wait for user input to accept or reject the chat
+                    self.inviting_sequence_number = message_received.header.sequence_number
+                    self.inviting_public_key = message_received.payload.message
+
+                    # The client answers with ACCEPT or REJECT, which is handled by `handle_client`
                     # - If user accepts, send SYNACK (via `handle_accept`)
-                    # - If user rejects, send FINERR ()
+                    # - If user rejects, send FINERR (via `handle_reject`)
+                    # NOTE: Reading the answer here too would race `handle_client` for the client's commands
                     print("\nWaiting for client to respond to chat invitation...")
-                    response: str = self.client_conn.recv(1024).decode('ascii')
-                    if response == "ACCEPT":
-                        self.handle_accept(
-                            message_received.header.sequence_number)
-                    else:
-                        self.handle_reject(
-                            message_received.header.sequence_number)
 
                 # If already in a chat, send error message
                 else:
@@ -195,20 +836,39 @@ class Daemon:
                     print(
                         f"\n!! Sent FINERR to {addr} because user is busy. !!\n")
                     # Communicate to client that another user tried to start a chat
-                    self.client_conn.sendall(
-                        f"User {message_received.header.user} tried to start a chat, but was automatically rejected.".encode('ascii'))
+                    self.send_to_client(
+                        f"User {message_received.header.user} tried to start a chat, but was automatically rejected.")
             elif message_received.header.operation == OperationType.SYNACK:
+                # Only a SYNACK answering our own SYN completes the key exchange
+                if self.key_exchange is None or addr != self.remote_addr or self.is_in_chat:
+                    print(
+                        f"\n!! Dropping SYNACK from {addr}, we did not invite it. !!\n")
+                    return
+                try:
+                    session: SessionCipher = self.key_exchange.derive(
+                        message_received.payload.message, initiator=True)
+                except ValueError as e:
+                    print(
+                        f"\n!! Dropping SYNACK from {addr}, key exchange failed: {e} !!\n")
+                    return
+                self.key_exchange = None
+                self.start_session(addr, session)
                 print(
                     f"\n** User {message_received.header.user} accepted the chat, connection established. **\n")
-                self.client_conn.sendall(
-                    f"Chat connection established with {message_received.header.user}.".encode('ascii'))
-                self.is_in_chat = True  # NOTE: This puts the initiator into the chat
-                self.remote_addr = addr
-                # Send ACK to the other user
-                self.send_ack(addr, message_received.header.sequence_number)
-                # Once we have received the SYNACK, we can toggle the sequence numbers
-                self.expected_sequence_number = 0x01 if self.expected_sequence_number == 0x00 else 0x00
-                self.send_sequence_number = 0x01 if self.send_sequence_number == 0x00 else 0x00
+                with self.pending_ack_lock:
+                    self.is_in_chat = True  # NOTE: This puts the initiator into the chat
+                    self.remote_addr = addr
+                    self.start_keepalive()
+                    # Send ACK to the other user (cached, so a retransmitted SYNACK gets ACKed again)
+                    # - the ACK is the first sealed datagram, proving to the other daemon that we have the keys
+                    self.receive_cache.forget(addr)
+                    self.accept_datagram(message_received, addr)
+                    # Once we have received the SYNACK, we can toggle the sequence numbers
+                    self.expected_sequence_number = 0x01 if self.expected_sequence_number == 0x00 else 0x00
+                    self.send_sequence_number = 0x01 if self.send_sequence_number == 0x00 else 0x00
+                # Only now tell the client, its first message has to use the new sequence number
+                self.send_to_client(
+                    f"Chat connection established with {message_received.header.user}.")
 
             elif message_received.header.operation == OperationType.ERR:
                 # TODO: Maybe even send to the client in the future?
@@ -216,101 +876,167 @@ class Daemon:
                 print(
                     f"\n!! Received an error message: {message_received.payload.message} !!\n")
                 # Send ACK about the ERR
-                self.send_ack(addr, message_received.header.sequence_number)
+                self.accept_datagram(message_received, addr)
                 pass
             # FIN: Other client wants to end the chat
             elif message_received.header.operation == OperationType.FIN:
-                self.send_ack(addr, message_received.header.sequence_number)
-                self.client_conn.sendall(
-                    f"!! User {message_received.header.user} ended the chat. !!".encode('ascii'))
-                self.is_in_chat = False
-                self.remote_addr = None
-                # Reset sequence numbers
-                self.send_sequence_number = 0x00
-                self.expected_sequence_number = 0x00
+                self.accept_datagram(message_received, addr)
+                self.end_session(addr)
+                self.send_to_client(
+                    f"!! User {message_received.header.user} ended the chat. !!")
+                with self.pending_ack_lock:
+                    self.reset_chat()
             # FINERR: Other client rejected the chat, or connection could not be established as no client was connected
             elif message_received.header.operation == OperationType.FINERR:
                 print(
                     f"\n!! Chat invitation rejected: {message_received.payload.message} !!\n")
-                self.client_conn.sendall(
-                    f"Connection could not be established: {message_received.payload.message}.".encode('ascii'))
+                self.send_to_client(
+                    f"Connection could not be established: {message_received.payload.message}.")
                 # Send ACK
-                self.send_ack(addr, message_received.header.sequence_number)
-                self.is_in_chat = False
-                self.remote_addr = None
-                # Reset sequence numbers
-                self.send_sequence_number = 0x00
-                self.expected_sequence_number = 0x00
+                self.accept_datagram(message_received, addr)
+                self.end_session(addr)
+                self.key_exchange = None
+                with self.pending_ack_lock:
+                    self.reset_chat()
             # ACK: The other client received the message
             elif message_received.header.operation == OperationType.ACK:
-                # Conditionally handle the ACK if we are waiting for the ACK of a SYNACK
-                if self.pending_invitation:
-                    print(
-                        f"\n** Connection establishment ACK by: {message_received.header.user} **\n")
-                    self.client_conn.sendall(
-                        f"Chat connection established with {message_received.header.user}.".encode('ascii'))
-                    self.pending_invitation = False
-                    self.inviting_user = None
-                    self.inviting_addr = None
-                    # Processed datagram, now we can toggle expected_sequence_number and send sequence number
-                    self.expected_sequence_number = 0x01 if self.expected_sequence_number == 0x00 else 0x00
-                    self.send_sequence_number = 0x01 if self.send_sequence_number == 0x00 else 0x00
-
-                # NEW: Handle the ACK of the retransmitted message
-                with self.pending_ack_lock:
-                    if self.pending_ack:
+                # NEW: Handle the ACK of the retransmitted message, and wake up the sender waiting for it
+                with self.ack_condition:
+                    if self.pending_ack and addr == self.pending_ack_addr:
+                        self.handle_ack_credit_and_rtt(message_received)
                         self.pending_ack = False
-                        if (message_received.header.operation == OperationType.ACK and message_received.header.sequence_number == self.send_sequence_number):
-                            print("Expected ACK received for retransmitted message.")
-                        self.send_sequence_number = 0x01 if self.send_sequence_number == 0x00 else 0x00
-                        self.expected_sequence_number = 0x01 if self.expected_sequence_number == 0x00 else 0x00
+                        self.ack_condition.notify_all()
+                        # ACKs from third parties (e.g. for rejecting them) don't toggle the sequence numbers
+                        if not self.pending_ack_skip_sequence_check:
+                            self.send_sequence_number = 0x01 if self.send_sequence_number == 0x00 else 0x00
+                            self.expected_sequence_number = 0x01 if self.expected_sequence_number == 0x00 else 0x00
+                            # Conditionally complete the handshake if we were waiting for the ACK of a SYNACK
+                            if self.pending_invitation and addr == self.inviting_addr:
+                                print(
+                                    f"\n** Connection establishment ACK by: {message_received.header.user} **\n")
+                                self.complete_handshake()
                         print(f"\n** Received ACK for retransmitted message. **\n")
         # 2. Chat message (simply forward to client and send ACK)
         elif message_received.header.message_type == MessageType.CHAT:
-            # ACK the chat message
-            self.send_ack(addr, message_received.header.sequence_number)
-            # Forward the chat message to the client
-            self.client_conn.sendall(
-                ("CHAT " + message_received.header.user + " " + message_received.payload.message).encode('ascii'))
+            # Flow control: if the client buffer is full, drop the message without ACKing it
+            # - the sender was told there is no credit left and keeps probing until there is space again
+            if self.client_queue.qsize() >= self.client_buffer_size:
+                print(
+                    f"\n!! Client buffer full, dropping chat message from {addr} until the client catches up. !!\n")
+                return
             # Processed datagram, now we can toggle expected_sequence_number and send sequence number
-            self.expected_sequence_number = 0x01 if self.expected_sequence_number == 0x00 else 0x00
-            self.send_sequence_number = 0x01 if self.send_sequence_number == 0x00 else 0x00
+            # - before the client sees the message, as its reply has to use the new sequence number
+            with self.pending_ack_lock:
+                self.expected_sequence_number = 0x01 if self.expected_sequence_number == 0x00 else 0x00
+                self.send_sequence_number = 0x01 if self.send_sequence_number == 0x00 else 0x00
+            # ACK the chat message, also before the client sees it, so the ACK is on its way before any reply
+            # - the advertised credit already counts the slot this message is going to take
+            self.accept_datagram(message_received, addr, reserved_credit=1)
+            # Forward the chat message to the client
+            self.send_to_client(
+                "CHAT " + message_received.header.user + " " + message_received.payload.message)
 
     # Start the daemon
 
     def start_daemon_listener(self) -> None:
-        # Timeout of 1 second for keyboard interrupt
+        # Short timeout, so that a drain does not have to wait long for the listener to stop
         print("** Starting SIMP daemon...")
         print(f"Listening for daemon connections on {self.host}:7777... **\n")
-        self.daemon_socket.settimeout(1.0)
-        # Loop forever
+        self.daemon_socket.settimeout(0.2)
+        self.listener_thread_id = threading.get_ident()
+        # Loop until the daemon shuts down or restarts
         try:
-            while True:
+            while not self.listener_stop.is_set():
                 try:
+                    # First the datagrams received while the last handling was waiting for an ACK
+                    # (or handed over by the daemon we were restarted from)
+                    if self.deferred_datagrams:
+                        message_received, addr, authenticated = self.deferred_datagrams.popleft()
+                        self.handle_datagram(
+                            message_received, addr, authenticated)
+                        continue
                     # time.sleep(0.15) # Minimie chance of race condition?
                     # Receive data with timeout
-                    data, addr = self.daemon_socket.recvfrom(1024)
-                    message_received = Datagram(data)
-                    print(
-                        f"\n<-----------\nDAEMON: Received datagram (in handle) from {addr}:\n{message_received}\n<-----------\n")
+                    data, addr = self.daemon_socket.recvfrom(65535)
+                    message_received, authenticated = self.open_datagram(
+                        data, addr)
+                    # Periodic announcements would flood the log, they are only logged when a new peer is discovered
+                    if message_received.header.operation != OperationType.ANNOUNCE:
+                        print(
+                            f"\n<-----------\nDAEMON: Received {'sealed ' if authenticated else ''}datagram (in handle) from {addr}:\n{message_received}\n<-----------\n")
                     # Handle the datagram
-                    self.handle_datagram(message_received, addr)
+                    self.handle_datagram(
+                        message_received, addr, authenticated)
                 except socket.timeout:
                     continue
-        except KeyboardInterrupt:
-            print("Exiting...")
-            self.daemon_socket.close()
+                except ValueError as e:
+                    print(
+                        f"\n!! Dropping invalid datagram from {addr}: {e} !!\n")
+                    continue
+        finally:
+            # Also if the listener died, so stopping it can't hang
+            self.listener_stopped.set()
         if self.has_been_connected:
             print("Daemon listener thread shutdown.")
 
+    # Stop the listener and wait until it finished the datagram it is handling
+    # - like the command in `drain`, without a timeout: a reply sent while handling waits at most for its
+    #   retransmissions, and the sockets must not be snapshotted or handed over while the listener still uses them
+    def stop_daemon_listener(self) -> None:
+        self.listener_stop.set()
+        if self.listener_thread_id is not None:
+            self.listener_stopped.wait()
+
+    # Receive broadcast announcements until the daemon shuts down or restarts
+    # - only ANNOUNCE datagrams are taken from the discovery socket, everything else goes to our unicast address
+    # - the socket is not handed over on a restart, the restarted daemon binds its own
+    def start_discovery_listener(self) -> None:
+        if self.discovery_socket is None:
+            return
+        self.discovery_socket.settimeout(0.2)
+        try:
+            while not self.listener_stop.is_set():
+                try:
+                    data, addr = self.discovery_socket.recvfrom(65535)
+                    message_received: Datagram = Datagram(data)
+                except socket.timeout:
+                    continue
+                except ValueError as e:
+                    print(
+                        f"\n!! Dropping invalid broadcast datagram from {addr}: {e} !!\n")
+                    continue
+                if message_received.header.operation == OperationType.ANNOUNCE:
+                    self.handle_announce(message_received, addr)
+        finally:
+            self.discovery_socket.close()
+
+    # Periodically announce the connected client's username and evict peers that stopped announcing
+    def start_discovery_announcer(self) -> None:
+        if self.client_is_connected and self.username:
+            for target in self.discovery_targets:
+                if target != (self.host, 7777):
+                    self.send_announce(target)
+        self.peer_cache.evict()
+        self.timers.schedule(self.announce_interval,
+                             self.start_discovery_announcer)
+
     def start_client_listener(self) -> None:
+        # A client handed over by the daemon we were restarted from stays connected, without a new handshake
+        if self.resumed_client is not None:
+            conn: socket.socket = self.resumed_client
+            self.resumed_client = None
+            threading.Thread(target=self.serve_client, args=(
+                conn, conn.getpeername()), daemon=True).start()
         print("\n** Waiting for client connection on port 7778... **\n")
-        while True:
+        # Polled, so that a drain stops it, connections arriving meanwhile wait in the backlog for the restarted daemon
+        while not self.draining:
+            ready, _, _ = select.select([self.client_socket], [], [], 0.2)
+            if not ready:
+                continue
             conn, addr = self.client_socket.accept()
             # Start a new thread to handle the connection
-            # Sleep for a short time to avoid busy-waiting
             threading.Thread(target=self.handle_client,
-                             args=(conn, addr)).start()
+                             args=(conn, addr), daemon=True).start()
 
     def handle_client(self, conn: socket.socket, addr: Tuple[str, int]) -> None:
         # Ensure thread safety with a lock and check if a client is already connected
@@ -326,6 +1052,7 @@ class Daemon:
                     "Only client, connection successfully established.".encode('ascii'))
                 self.username = self.client_conn.recv(1024).decode('ascii')
                 print(f"**Client username set: {self.username}**")
+                self.start_client_writer()
             # If there is already a client connected, reject the new connection using the connection
             else:
                 # Client is already connected, reject the new connection
@@ -337,60 +1064,143 @@ class Daemon:
                 return
 
         # Handle the client connection if it is accepted
+        self.serve_client(conn, addr)
+
+    # Start a fresh writer for the connected client
+    def start_client_writer(self) -> None:
+        self.client_queue = queue.Queue()
+        self.client_writer_thread = threading.Thread(target=self.client_writer, args=(
+            self.client_conn, self.client_queue), daemon=True)
+        self.client_writer_thread.start()
+
+    # Stop the writer of the client once it wrote everything queued, returns the messages it could not write in time
+    def stop_client_writer(self, timeout: float = 5.0) -> List[str]:
+        self.client_queue.put(None)
+        if self.client_writer_thread is not None:
+            self.client_writer_thread.join(timeout)
+        unwritten: List[str] = []
+        while not self.client_queue.empty():
+            message: Optional[str] = self.client_queue.get()
+            if message is not None:
+                unwritten.append(message)
+        return unwritten
+
+    # Handle the commands of the connected client until it disconnects
+    def serve_client(self, conn: socket.socket, addr: Tuple[str, int]) -> None:
         try:
-            with self.client_conn:
+            with conn:
                 while True:
-                    data = self.client_conn.recv(1024)
-                    if not data:
-                        break
-                    command = data.decode('ascii')
-                    if command.startswith("CONNECT"):
-                        # Handle client wanting to connect to another user
-                        # - get the details of the other user from the command
-                        # - send a SYN message to the other user
-                        # - wait for a SYNACK message from the other user
-                        #   - IF SYNACK received, start chat
-                        #   - IF FINERR received, send ERR to client "connection not established"
-                        remote_ip = command.split(" ")[1]
-                        self.remote_addr = (remote_ip, 7777)
-                        datagram = message_to_datagram(
-                            MessageType.CONTROL, OperationType.SYN, self.send_sequence_number, self.username, "")
-
-                        # NOTE: SYN message does not use retransmission on purpose
-                        self.daemon_socket.sendto(datagram, self.remote_addr)
-                        print(
-                            f"\n----------->\nDAEMON: Sending datagram {self.remote_addr}:\n{Datagram(datagram)}\n----------->\n")
-                        pass
-                    elif command.startswith("CHAT"):
-                        # Handle client wanting to send a chat message
-                        # - get the message from the command
-                        # - IF not in chat, send an ERR message to the client
-                        # - ELSE send a CHAT message to the other user
-                        message = command.split(" ", 1)[1]
-                        if self.is_in_chat:
+                    # While draining, commands stay unread in the socket (for the restarted daemon)
+                    if self.draining:
+                        time.sleep(0.2)
+                        continue
+                    with self.command_lock:
+                        if self.draining:
+                            continue
+                        ready, _, _ = select.select([conn], [], [], 0.2)
+                        if not ready:
+                            continue
+                        data = conn.recv(1024)
+                        if not data:
+                            break
+                        command = data.decode('ascii')
+                        if command.startswith("CONNECT"):
+                            # Handle client wanting to connect to another user
+                            # - get the details of the other user from the command
+                            # - send a SYN message to the other user
+                            # - wait for a SYNACK message from the other user
+                            #   - IF SYNACK received, start chat
+                            #   - IF FINERR received, send ERR to client "connection not established"
+                            # - the target is either an IP or the username of a peer found via discovery
+                            target = command.split(" ")[1]
+                            remote_addr = self.resolve_peer(target)
+                            if remote_addr is None:
+                                self.send_to_client(
+                                    f"Connection could not be established: unknown user {target}.")
+                                continue
+                            with self.pending_ack_lock:
+                                self.remote_addr = remote_addr
+                            # New chat attempt, a reply identical to one from an earlier attempt is not a duplicate
+                            self.receive_cache.forget(self.remote_addr)
+                            # Our half of the key exchange goes into the SYN
+                            self.key_exchange = KeyExchange()
                             datagram = message_to_datagram(
-                                MessageType.CHAT, OperationType.ERR, self.send_sequence_number, self.username, message)
-                            self.send_with_retransmission(
-                                datagram, self.remote_addr)
+                                MessageType.CONTROL, OperationType.SYN, self.send_sequence_number, self.username, self.key_exchange.public_key)
+
+                            # NOTE: SYN message does not use retransmission on purpose
+                            self.send_datagram(datagram, self.remote_addr)
+                            print(
+                                f"\n----------->\nDAEMON: Sending datagram {self.remote_addr}:\n{Datagram(datagram)}\n----------->\n")
+                            pass
+                        elif command.startswith("CHAT"):
+                            # Handle client wanting to send a chat message
+                            # - get the message from the command
+                            # - IF not in chat, send an ERR message to the client
+                            # - ELSE send a CHAT message to the other user
+                            message = command.split(" ", 1)[1]
+                            if self.is_in_chat:
+                                datagram = message_to_datagram(
+                                    MessageType.CHAT, OperationType.ERR, self.send_sequence_number, self.username, message)
+                                self.send_with_retransmission(
+                                    datagram, self.remote_addr)
+                            elif self.group_session and self.in_group_chat():
+                                self.group_session.send(message)
+                            else:
+                                print("Client is not in chat, cannot send message.")
+                                self.send_to_client(
+                                    "Not in chat, can not send message.")
+                            pass
+                        elif command.startswith("GROUP"):
+                            # Handle client wanting to start a group chat
+                            # - the members are given as IPs or usernames of discovered peers
+                            # - no handshake, members simply start receiving the group's messages
+                            if self.is_in_chat or self.pending_invitation:
+                                self.send_to_client(
+                                    "Can not start a group chat while in a chat.")
+                                continue
+                            if len(command.split(" ")) < 2:
+                                self.send_to_client(
+                                    "A group chat needs at least one member.")
+                                continue
+                            members: List[Tuple[str, int]] = []
+                            for target in command.split(" ")[1:]:
+                                member_addr = self.resolve_peer(target)
+                                if member_addr is None:
+                                    self.send_to_client(
+                                        f"Connection could not be established: unknown user {target}.")
+                                    break
+                                if member_addr not in members:
+                                    members.append(member_addr)
+                            else:
+                                if self.group_session:
+                                    self.group_session.close()
+                                self.group_session = GroupSession(self, members)
+                                self.send_to_client(
+                                    f"Group chat established with {', '.join(addr[0] for addr in members)}.")
+                        elif command.startswith("LEAVE"):
+                            # Handle client wanting to end its group chat, without quitting
+                            # - the members are not told, they simply stop receiving the group's messages
+                            if self.group_session and self.in_group_chat():
+                                self.group_session.close()
+                                self.group_session = None
+                                self.send_to_client(
+                                    "!! You left, group chat ended. !!")
+                            else:
+                                self.send_to_client("Not in a group chat.")
+                        elif command.startswith("QUIT"):
+                            # NOTE: This just breaks the loop, as there is cleanup needed
+                            # - if the user deliberately quits or
+                            # - if the user is disconnected
+
+                            print(f"Client user quit deliberately.")
+                            break
+                        elif command.startswith("ACCEPT"):
+                            self.handle_accept(self.inviting_sequence_number)
+                        elif command.startswith("REJECT"):
+                            self.handle_reject(self.inviting_sequence_number)
                         else:
-                            print("Client is not in chat, cannot send message.")
-                            self.client_conn.sendall(
-                                "Not in chat, can not send message.".encode('ascii'))
-                        pass
-                    elif command.startswith("QUIT"):
-                        # NOTE: This just breaks the loop, as there is cleanup needed
-                        # - if the user deliberately quits or
-                        # - if the user is disconnected
-
-                        print(f"Client user quit deliberately.")
-                        break
-                    elif command.startswith("ACCEPT"):
-                        self.handle_accept(0x00)
-                    elif command.startswith("REJECT"):
-                        self.handle_reject(0x00)
-                    else:
-                        print(
-                            f"Received invalid command from client: {command}")
+                            print(
+                                f"Received invalid command from client: {command}")
         except Exception as e:
             print(f"Error in handle_client: {e}")
         finally:
@@ -400,13 +1210,17 @@ class Daemon:
                 datagram = message_to_datagram(
                     MessageType.CONTROL, OperationType.FIN, self.send_sequence_number, self.username, "")  # TODO: Sequence number
                 self.send_with_retransmission(datagram, self.remote_addr)
+                self.end_session(self.remote_addr)
                 # Set flags
-                self.is_in_chat = False
-                self.remote_addr = None
+                with self.pending_ack_lock:
+                    self.reset_chat()
                 self.client_conn.close()
-                # Reset sequence numbers
-                self.send_sequence_number = 0x00
-                self.expected_sequence_number = 0x00
+            # End our group chat, if any
+            if self.group_session:
+                self.group_session.close()
+                self.group_session = None
+            # Stop the writer of this client
+            self.client_queue.put(None)
             with self.client_lock:
                 self.client_is_connected = False
 
@@ -415,29 +1229,39 @@ class Daemon:
     def handle_accept(self, syn_sequence_number: int) -> None:
         print("\n** Handling accept... **\n")
         if self.pending_invitation and self.inviting_addr:
+            # Complete the key exchange, the session starts now so that the ACK of our SYNACK has to be sealed already
+            key_exchange: KeyExchange = KeyExchange()
+            self.start_session(self.inviting_addr, key_exchange.derive(
+                self.inviting_public_key, initiator=False))
             # Send SYNACK to the remote daemon
             datagram: bytes = message_to_datagram(
-                MessageType.CONTROL, OperationType.SYNACK, syn_sequence_number, self.username, "")
+                MessageType.CONTROL, OperationType.SYNACK, syn_sequence_number, self.username, key_exchange.public_key)
             success: bool = self.send_with_retransmission(
                 datagram, self.inviting_addr)
-            if success:
-                print(
-                    f"\n** Received ACK from user {self.inviting_user} **\n")
-                self.client_conn.sendall(
-                    f"Chat connection established with {self.inviting_user}.".encode('ascii'))
+            # If the listener thread got the ACK, it has already completed the handshake
+            with self.pending_ack_lock:
+                if success and self.pending_invitation:
+                    self.complete_handshake()
 
-                # Set the chat details
-                self.is_in_chat = True
-                self.remote_addr = self.inviting_addr
+        else:
+            self.send_to_client(
+                "No pending chat invitations to accept.")
 
-                # Reset the invitation details
-                self.pending_invitation = False
-                self.inviting_addr = None
-                self.inviting_user = None
+    # Enter the chat with the inviting user, once the ACK of our SYNACK arrived (call holding `pending_ack_lock`)
+    def complete_handshake(self) -> None:
+        print(f"\n** Received ACK from user {self.inviting_user} **\n")
+        self.send_to_client(
+            f"Chat connection established with {self.inviting_user}.")
 
-        else:
-            self.client_conn.sendall(
-                "No pending chat invitations to accept.".encode('ascii'))
+        # Set the chat details
+        self.is_in_chat = True
+        self.remote_addr = self.inviting_addr
+        self.start_keepalive()
+
+        # Reset the invitation details
+        self.pending_invitation = False
+        self.inviting_addr = None
+        self.inviting_user = None
 
     def handle_reject(self, syn_sequence_number: int) -> None:
         if self.pending_invitation and self.inviting_addr:
@@ -450,28 +1274,211 @@ class Daemon:
             print(f"\n**Sent FINERR to {self.inviting_addr}**\n")
 
             # Notify the client of successful rejection
-            self.client_conn.sendall(
-                "Chat invitation rejected.".encode('ascii'))
+            self.send_to_client(
+                "Chat invitation rejected.")
 
             # Reset the invitation details
             self.pending_invitation = False
             self.inviting_addr = None
             self.inviting_user = None
         else:
-            self.client_conn.sendall(
-                "No pending chat invitations to reject.".encode('ascii'))
+            self.send_to_client(
+                "No pending chat invitations to reject.")
+
+    # Wrap a socket inherited from the daemon we were restarted from
+    @staticmethod
+    def inherit_socket(fd: int) -> socket.socket:
+        inherited: socket.socket = socket.socket(fileno=fd)
+        # The old daemon may have left it non-blocking (a timeout is kept on the file descriptor, not the socket object)
+        inherited.setblocking(True)
+        return inherited
+
+    # Stop taking new client commands and connections, and wait for the command being handled to finish
+    # (including the datagram it is waiting for an ACK for), must not be called from a daemon thread
+    def drain(self) -> None:
+        print("\n** Draining... **\n")
+        self.draining = True
+        # A client handshake in progress has to finish first (the client sends its username right away)
+        if self.client_lock.acquire(timeout=5.0):
+            self.client_lock.release()
+        with self.command_lock:
+            pass
+
+    # The state of the daemon, as JSON compatible data for the restarted daemon
+    # - `client_messages` are the ones for the client that were not written yet
+    # NOTE: The sessions use up a nonce each, so nothing may be sent afterwards
+    def snapshot(self, client_messages: List[str]) -> Dict[str, Any]:
+        return {
+            'username': self.username,
+            'has_been_connected': self.has_been_connected,
+            'client_is_connected': self.client_is_connected,
+            'client_messages': client_messages,
+            'deferred_datagrams': [[datagram.bytes.hex(), list(addr), authenticated] for datagram, addr, authenticated in self.deferred_datagrams],
+            'send_sequence_number': self.send_sequence_number,
+            'expected_sequence_number': self.expected_sequence_number,
+            'receive_cache': self.receive_cache.to_dict(),
+            'pending_invitation': self.pending_invitation,
+            'inviting_user': self.inviting_user,
+            'inviting_addr': self.inviting_addr,
+            'inviting_sequence_number': self.inviting_sequence_number,
+            'inviting_public_key': self.inviting_public_key,
+            'remote_addr': self.remote_addr,
+            'is_in_chat': self.is_in_chat,
+            'group_session': self.group_session.to_dict() if self.group_session else None,
+            'group_senders': [[list(addr), group_id, message_number] for addr, (group_id, message_number) in self.group_senders.items()],
+            'peer_credit': self.peer_credit,
+            'retransmission_timer': self.retransmission_timer.to_dict(),
+            'key_exchange': self.key_exchange.private_key if self.key_exchange else None,
+            'sessions': [[list(addr), session.to_dict()] for addr, session in self.sessions.items()],
+            'peer_cache': self.peer_cache.to_dict(),
+        }
+
+    # Resume from the snapshot of the daemon we were restarted from
+    def restore(self, snapshot: Dict[str, Any]) -> None:
+        def to_addr(addr: Optional[List[Any]]) -> Optional[Tuple[str, int]]:
+            return (addr[0], addr[1]) if addr else None
+
+        self.username = snapshot['username']
+        self.has_been_connected = snapshot['has_been_connected']
+        self.send_sequence_number = snapshot['send_sequence_number']
+        self.expected_sequence_number = snapshot['expected_sequence_number']
+        self.receive_cache = ReceiveCache.from_dict(snapshot['receive_cache'])
+        self.pending_invitation = snapshot['pending_invitation']
+        self.inviting_user = snapshot['inviting_user']
+        self.inviting_addr = to_addr(  # type: ignore[assignment]
+            snapshot['inviting_addr'])
+        self.inviting_sequence_number = snapshot['inviting_sequence_number']
+        self.inviting_public_key = snapshot['inviting_public_key']
+        self.remote_addr = to_addr(snapshot['remote_addr'])
+        self.is_in_chat = snapshot['is_in_chat']
+        self.group_senders = {(addr[0], addr[1]): (group_id, message_number)
+                              for addr, group_id, message_number in snapshot['group_senders']}
+        self.peer_credit = snapshot['peer_credit']
+        self.retransmission_timer = RetransmissionTimer.from_dict(
+            snapshot['retransmission_timer'])
+        if snapshot['key_exchange'] is not None:
+            self.key_exchange = KeyExchange(snapshot['key_exchange'])
+        now: float = time.time()
+        for addr, state in snapshot['sessions']:
+            session: SessionCipher = SessionCipher.from_dict(state)
+            self.sessions[(addr[0], addr[1])] = session
+            if session.expires_at is not None:
+                self.timers.schedule(max(session.expires_at - now, 0.0),
+                                     self.evict_session, (addr[0], addr[1]), session)
+        self.peer_cache = PeerCache.from_dict(snapshot['peer_cache'])
+        self.deferred_datagrams = deque((Datagram(bytes.fromhex(data)), (addr[0], addr[1]), authenticated)
+                                        for data, addr, authenticated in snapshot['deferred_datagrams'])
+        if snapshot['client_is_connected'] and 'client' in snapshot['fds']:
+            self.client_conn = self.inherit_socket(snapshot['fds']['client'])
+            self.client_is_connected = True
+            self.resumed_client = self.client_conn
+            self.start_client_writer()
+            for message in snapshot['client_messages']:
+                self.send_to_client(message)
+        if snapshot['group_session'] is not None:
+            self.group_session = GroupSession.from_dict(
+                self, snapshot['group_session'])
+        if self.is_in_chat:
+            self.start_keepalive()
+        print(
+            f"** Resumed from snapshot{f', in chat with {self.remote_addr}' if self.is_in_chat else ''} **")
+
+    # Drain and stop every thread, then return the snapshot of the daemon with the file descriptors of its sockets
+    # - the sockets are detached, so they stay open (and keep buffering) for the restarted daemon
+    def prepare_restart(self) -> Dict[str, Any]:
+        self.drain()
+        self.stop_daemon_listener()
+        self.timers.stop()
+        client_messages: List[str] = self.stop_client_writer(
+        ) if self.client_is_connected else []
+        snapshot: Dict[str, Any] = self.snapshot(client_messages)
+        fds: Dict[str, int] = {'daemon': self.daemon_socket.detach(),
+                               'client_listener': self.client_socket.detach()}
+        if self.client_is_connected and self.client_conn:
+            fds['client'] = self.client_conn.detach()
+        snapshot['fds'] = fds
+        return snapshot
+
+    # Restart the daemon in place (on SIGHUP), e.g. to pick up new code, without dropping anything
+    # - the new process inherits the sockets and resumes from a snapshot, so the client stays connected,
+    #   the chat partner keeps its session and whatever arrived in between is still in the socket buffers
+    # - the snapshot holds the session keys, so it is written to a file only we can read and removed once loaded
+    def hot_restart(self) -> None:
+        if self.draining:
+            return
+        print("\n** Restarting daemon... **\n")
+        snapshot: Dict[str, Any] = self.prepare_restart()
+        for fd in snapshot['fds'].values():
+            os.set_inheritable(fd, True)
+        snapshot_fd, snapshot_path = tempfile.mkstemp(
+            prefix='simp-', suffix='.json')
+        with os.fdopen(snapshot_fd, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        os.environ[SNAPSHOT_ENV] = snapshot_path
+        sys.stdout.flush()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    # Shut down gracefully (on SIGTERM or Ctrl+C): finish the work in flight, end the chats and close the sockets
+    def shutdown(self) -> None:
+        if self.draining:
+            return
+        print("\n** Shutting down daemon... **\n")
+        self.drain()
+        # The listener still runs, so the FIN can be ACKed
+        if self.is_in_chat and self.remote_addr:
+            datagram: bytes = message_to_datagram(
+                MessageType.CONTROL, OperationType.FIN, self.send_sequence_number, self.username, "")
+            self.send_with_retransmission(datagram, self.remote_addr)
+            self.end_session(self.remote_addr)
+            with self.pending_ack_lock:
+                self.reset_chat()
+            self.send_to_client("!! Daemon shut down, ended the chat. !!")
+        if self.group_session:
+            self.group_session.close()
+            self.group_session = None
+        self.stop_daemon_listener()
+        self.timers.stop()
+        if self.client_is_connected and self.client_conn:
+            self.stop_client_writer()
+            self.client_conn.close()
+        self.daemon_socket.close()
+        self.client_socket.close()
+        print("** Daemon shut down. **")
+
+
+# The snapshot left by the daemon we were restarted from, if we were restarted
+def load_snapshot() -> Optional[Dict[str, Any]]:
+    snapshot_path: Optional[str] = os.environ.pop(SNAPSHOT_ENV, None)
+    if snapshot_path is None:
+        return None
+    with open(snapshot_path) as snapshot_file:
+        snapshot: Dict[str, Any] = json.load(snapshot_file)
+    os.remove(snapshot_path)
+    return snapshot
 
 
 def show_usage():
-    print("Usage: simp_daemon.py <host>")
+    print("Usage: simp_daemon.py <host> [discovery_peer ...]")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
+    if len(sys.argv) < 2:
         show_usage()
         exit(1)
 
-    # Start the daemon
-    daemon = Daemon(sys.argv[1])
-    threading.Thread(target=daemon.start_client_listener).start()
-    threading.Thread(target=daemon.start_daemon_listener).start()
+    # Start the daemon (resuming where it left off, if it was restarted)
+    daemon = Daemon(sys.argv[1], sys.argv[2:], load_snapshot())
+    threading.Thread(target=daemon.start_client_listener, daemon=True).start()
+    threading.Thread(target=daemon.start_daemon_listener, daemon=True).start()
+    threading.Thread(target=daemon.start_discovery_listener, daemon=True).start()
+    daemon.start_discovery_announcer()
+
+    # Signals are handled by the main thread, which only waits for them
+    # - SIGHUP restarts the daemon in place, SIGTERM and Ctrl+C shut it down gracefully
+    signal.signal(signal.SIGHUP, lambda signum, frame: daemon.hot_restart())
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        daemon.shutdown()
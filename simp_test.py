@@ -0,0 +1,1092 @@
+#!/usr/bin/env python3
+
+# Tests and benchmarks for SIMP, run with `python3 -m unittest simp_test` (or `python3 -m pytest simp_test.py`)
+# - the fuzz tests are seeded, set SIMP_FUZZ_SEED to try other inputs and SIMP_FUZZ_ITERATIONS for more of them
+# - the stress test runs two Daemons on 127.0.0.51 and 127.0.0.52, SIMP_STRESS_MESSAGES sets how many messages are sent
+# - the benchmark fails if throughput drops below the stored baseline, SIMP_UPDATE_BASELINE=1 stores a new one
+
+import contextlib
+import itertools
+import json
+import os
+import random
+import re
+import socket
+import threading
+import time
+import unittest
+from typing import Dict, List, Optional, Tuple
+
+from simp_classes import MODP_PRIME, Datagram, KeyExchange, MessageType, OperationType, PeerCache, ReceiveCache, ReplayWindow, RetransmissionTimer, SessionCipher, TimerHeap, message_to_datagram
+from simp_daemon import Daemon, GroupSession
+
+FUZZ_SEED: int = int(os.environ.get('SIMP_FUZZ_SEED', '7777'))
+FUZZ_ITERATIONS: int = int(os.environ.get('SIMP_FUZZ_ITERATIONS', '2000'))
+STRESS_MESSAGES: int = int(os.environ.get('SIMP_STRESS_MESSAGES', '1000'))
+BASELINE_PATH: str = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), 'simp_benchmark_baseline.json')
+# How much slower than the baseline we may get before the benchmark fails (machines and load differ)
+BENCHMARK_TOLERANCE: float = float(
+    os.environ.get('SIMP_BENCHMARK_TOLERANCE', '0.5'))
+
+# Every valid (type, operation) combination, and what its payload is: text, none, credit digits or a hex public key
+VALID_COMBINATIONS: List[Tuple[MessageType, OperationType, str]] = [
+    (MessageType.CONTROL, OperationType.ERR, 'text'),
+    (MessageType.CONTROL, OperationType.SYN, 'key'),
+    (MessageType.CONTROL, OperationType.ACK, 'credit'),
+    (MessageType.CONTROL, OperationType.SYNACK, 'key'),
+    (MessageType.CONTROL, OperationType.FIN, 'none'),
+    (MessageType.CONTROL, OperationType.FINERR, 'text'),
+    (MessageType.CONTROL, OperationType.ANNOUNCE, 'none'),
+    (MessageType.CONTROL, OperationType.KEEPALIVE, 'none'),
+    (MessageType.CONTROL, OperationType.KEEPALIVEACK, 'none'),
+    (MessageType.CHAT, OperationType.ERR, 'text'),
+    (MessageType.GROUP, OperationType.ERR, 'group'),
+    (MessageType.GROUP, OperationType.ACK, 'credit'),
+]
+
+
+def random_ascii(rng: random.Random, min_length: int, max_length: int) -> str:
+    return ''.join(chr(rng.randrange(128)) for _ in range(rng.randint(min_length, max_length)))
+
+
+# Arguments of `message_to_datagram` that make up a valid datagram
+def random_message(rng: random.Random) -> Tuple[MessageType, OperationType, int, str, str]:
+    message_type, operation, payload_kind = rng.choice(VALID_COMBINATIONS)
+    if payload_kind == 'credit':
+        payload: str = rng.choice(['', str(rng.randrange(1000))])
+    elif payload_kind == 'key':
+        payload = format(rng.getrandbits(2048), 'x')
+    elif payload_kind == 'text':
+        payload = random_ascii(rng, 1, 200)
+    elif payload_kind == 'group':
+        payload = format(rng.getrandbits(64), '016x') + ' ' + random_ascii(rng, 1, 200)
+    else:
+        payload = ''
+    # Trailing null bytes are padding, so they can't be part of a user name
+    user: str = random_ascii(rng, 0, 32).rstrip('\x00')
+    return message_type, operation, rng.randint(0, 1), user, payload
+
+
+class DatagramFuzzTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.rng: random.Random = random.Random(FUZZ_SEED)
+
+    def test_round_trip(self) -> None:
+        for _ in range(FUZZ_ITERATIONS):
+            message_type, operation, sequence_number, user, payload = random_message(
+                self.rng)
+            data: bytes = message_to_datagram(
+                message_type, operation, sequence_number, user, payload)
+            datagram = Datagram(data)
+            self.assertEqual(datagram.header.message_type, message_type)
+            self.assertEqual(datagram.header.operation, operation)
+            self.assertEqual(datagram.header.sequence_number, sequence_number)
+            self.assertEqual(datagram.header.user, user)
+            self.assertEqual(datagram.header.payload_size, len(payload))
+            self.assertEqual(datagram.payload.message, payload)
+            self.assertEqual(datagram.bytes, data)
+
+    # Whatever arrives on the socket, parsing either succeeds with a consistent datagram or raises a ValueError
+    def test_mutated_bytes(self) -> None:
+        for _ in range(FUZZ_ITERATIONS):
+            data = bytearray(message_to_datagram(*random_message(self.rng)))
+            for _ in range(self.rng.randint(1, 4)):
+                data[self.rng.randrange(len(data))] = self.rng.randrange(256)
+            try:
+                datagram = Datagram(bytes(data))
+            except ValueError:
+                continue
+            self.assertEqual(datagram.header.payload_size,
+                             len(datagram.payload.bytes))
+            self.assertIn(datagram.header.sequence_number, [0x00, 0x01])
+
+    def test_random_bytes(self) -> None:
+        for _ in range(FUZZ_ITERATIONS):
+            data: bytes = bytes(self.rng.randrange(256)
+                                for _ in range(self.rng.randint(0, 80)))
+            try:
+                Datagram(data)
+            except ValueError:
+                pass
+
+    def test_truncated(self) -> None:
+        for _ in range(FUZZ_ITERATIONS // 10):
+            data: bytes = message_to_datagram(*random_message(self.rng))
+            for length in range(len(data)):
+                with self.assertRaises(ValueError):
+                    Datagram(data[:length])
+
+    def test_mismatched_payload_size(self) -> None:
+        for _ in range(FUZZ_ITERATIONS):
+            data: bytes = message_to_datagram(*random_message(self.rng))
+            payload_size: int = len(data) - 39
+            wrong_size: int = self.rng.choice([payload_size + self.rng.randint(1, 1000),
+                                               self.rng.randrange(2**32)])
+            if wrong_size == payload_size:
+                continue
+            with self.assertRaises(ValueError):
+                Datagram(data[:35] + wrong_size.to_bytes(4, 'big') + data[39:])
+        # Extra bytes after the payload are not silently ignored either
+        with self.assertRaises(ValueError):
+            Datagram(message_to_datagram(MessageType.CHAT,
+                     OperationType.ERR, 0, 'alice', 'hi') + b'!')
+
+    def test_invalid_enum_values(self) -> None:
+        data: bytes = message_to_datagram(
+            MessageType.CHAT, OperationType.ERR, 0, 'alice', 'hi')
+        message_types: List[int] = [t.value for t in MessageType]
+        operations: List[int] = [o.value for o in OperationType]
+        for value in range(256):
+            if value not in message_types:
+                with self.assertRaises(ValueError):
+                    Datagram(bytes([value]) + data[1:])
+            if value not in operations:
+                with self.assertRaises(ValueError):
+                    Datagram(data[:1] + bytes([value]) + data[2:])
+            if value not in [0x00, 0x01]:
+                with self.assertRaises(ValueError):
+                    Datagram(data[:2] + bytes([value]) + data[3:])
+
+    def test_non_ascii(self) -> None:
+        data: bytes = message_to_datagram(
+            MessageType.CHAT, OperationType.ERR, 0, 'alice', 'hi')
+        with self.assertRaises(ValueError):
+            Datagram(data[:3] + b'\xff' + data[4:])
+        with self.assertRaises(ValueError):
+            Datagram(data[:-1] + b'\xff')
+
+    # Invalid combinations are rejected when encoding, valid ones always parse back
+    def test_message_to_datagram_arguments(self) -> None:
+        for _ in range(FUZZ_ITERATIONS):
+            message_type: MessageType = self.rng.choice(list(MessageType))
+            operation: OperationType = self.rng.choice(list(OperationType))
+            payload: str = self.rng.choice(
+                ['', str(self.rng.randrange(100)), random_ascii(self.rng, 1, 20)])
+            try:
+                data: bytes = message_to_datagram(
+                    message_type, operation, 0, 'alice', payload)
+            except ValueError:
+                continue
+            self.assertIn(
+                (message_type, operation), [(t, o) for t, o, _ in VALID_COMBINATIONS])
+            self.assertEqual(Datagram(data).payload.message, payload)
+
+        invalid_arguments: List[Tuple] = [
+            (0x02, OperationType.ERR, 0, 'alice', 'hi'),
+            (MessageType.CHAT, 0x01, 0, 'alice', 'hi'),
+            (MessageType.CHAT, OperationType.ERR, 2, 'alice', 'hi'),
+            (MessageType.CHAT, OperationType.ERR, '0', 'alice', 'hi'),
+            (MessageType.CHAT, OperationType.ERR, 0, b'alice', 'hi'),
+            (MessageType.CHAT, OperationType.ERR, 0, 'alice', b'hi'),
+            (MessageType.CHAT, OperationType.ERR, 0, 'a' * 33, 'hi'),
+            (MessageType.CHAT, OperationType.ERR, 0, 'alice', 'hé'),
+            (MessageType.CHAT, OperationType.ERR, 0, 'alice', ''),
+            (MessageType.CHAT, OperationType.ACK, 0, 'alice', 'hi'),
+            (MessageType.CONTROL, OperationType.SYN, 0, 'alice', 'hi'),
+            (MessageType.CONTROL, OperationType.ACK, 0, 'alice', 'credit'),
+            (MessageType.CONTROL, OperationType.FINERR, 0, 'alice', ''),
+            (MessageType.GROUP, OperationType.SYN, 0, 'alice', ''),
+            (MessageType.GROUP, OperationType.ERR, 0, 'alice', 'hi'),
+            (MessageType.GROUP, OperationType.ERR, 0, 'alice', '000000010000000g hi'),
+            (MessageType.GROUP, OperationType.ERR, 0, 'alice', '00000001 hi'),
+            (MessageType.GROUP, OperationType.ERR, 0, 'alice', '0000000100000000 '),
+        ]
+        for arguments in invalid_arguments:
+            with self.assertRaises(ValueError, msg=repr(arguments)):
+                message_to_datagram(*arguments)
+
+
+class ReceiveCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cache: ReceiveCache = ReceiveCache(max_entries=4, ttl=30.0)
+        self.addr: Tuple[str, int] = ('127.0.0.2', 7777)
+        self.data: bytes = message_to_datagram(
+            MessageType.CHAT, OperationType.ERR, 0, 'alice', 'hi')
+        self.ack: bytes = message_to_datagram(
+            MessageType.CONTROL, OperationType.ACK, 0, 'bob', '32')
+
+    def test_retransmission_is_answered(self) -> None:
+        self.cache.store(self.addr, self.data, self.ack)
+        self.assertEqual(self.cache.lookup(self.addr, self.data), self.ack)
+        # Same sequence number, but a different message or a different peer
+        self.assertIsNone(self.cache.lookup(self.addr, message_to_datagram(
+            MessageType.CHAT, OperationType.ERR, 0, 'alice', 'ho')))
+        self.assertIsNone(self.cache.lookup(('127.0.0.3', 7777), self.data))
+
+    def test_next_sequence_number_replaces_entry(self) -> None:
+        self.cache.store(self.addr, self.data, self.ack)
+        self.cache.store(self.addr, message_to_datagram(
+            MessageType.CHAT, OperationType.ERR, 1, 'alice', 'ho'), self.ack)
+        self.assertIsNone(self.cache.lookup(self.addr, self.data))
+
+    def test_bounded_and_expiring(self) -> None:
+        for i in range(10):
+            self.cache.store(('127.0.0.%d' % i, 7777), self.data, self.ack)
+        self.assertEqual(len(self.cache.entries), 4)
+        self.cache.evict(time.time() + 60)
+        self.assertEqual(len(self.cache.entries), 0)
+
+    def test_forget(self) -> None:
+        self.cache.store(self.addr, self.data, self.ack)
+        self.cache.forget(('127.0.0.3', 7777))
+        self.assertIsNotNone(self.cache.lookup(self.addr, self.data))
+        self.cache.forget(self.addr)
+        self.assertIsNone(self.cache.lookup(self.addr, self.data))
+
+
+class PeerCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cache: PeerCache = PeerCache(ttl=30.0)
+        self.addr: Tuple[str, int] = ('127.0.0.2', 7777)
+
+    def test_store_and_resolve(self) -> None:
+        self.assertIsNone(self.cache.resolve('bob'))
+        self.assertTrue(self.cache.store('bob', self.addr))
+        # Refreshing a known peer is not news, moving to another address is
+        self.assertFalse(self.cache.store('bob', self.addr))
+        self.assertTrue(self.cache.store('bob', ('127.0.0.3', 7777)))
+        self.assertEqual(self.cache.resolve('bob'), ('127.0.0.3', 7777))
+
+    def test_expiring(self) -> None:
+        cache: PeerCache = PeerCache(ttl=0.05)
+        cache.store('bob', self.addr)
+        cache.store('carol', ('127.0.0.3', 7777))
+        time.sleep(0.1)
+        # Expired peers are not resolved, and evicted without being looked up
+        self.assertIsNone(cache.resolve('bob'))
+        cache.evict()
+        self.assertEqual(cache.entries, {})
+        # An expired peer that announces again is new again
+        self.assertTrue(cache.store('bob', self.addr))
+
+
+class RetransmissionTimerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.timer: RetransmissionTimer = RetransmissionTimer(
+            initial_rto=5.0, min_rto=1.0, max_rto=30.0)
+
+    def test_first_sample(self) -> None:
+        self.timer.on_rtt_sample(2.0)
+        self.assertEqual(self.timer.srtt, 2.0)
+        self.assertEqual(self.timer.rttvar, 1.0)
+        self.assertEqual(self.timer.rto, 6.0)
+
+    def test_later_samples(self) -> None:
+        self.timer.on_rtt_sample(2.0)
+        self.timer.on_rtt_sample(4.0)
+        # RTTVAR = 3/4 * 1 + 1/4 * |2 - 4|, SRTT = 7/8 * 2 + 1/8 * 4
+        self.assertAlmostEqual(self.timer.rttvar, 1.25)
+        self.assertAlmostEqual(self.timer.srtt, 2.25)
+        self.assertAlmostEqual(self.timer.rto, 7.25)
+
+    def test_bounds(self) -> None:
+        self.timer.on_rtt_sample(0.01)
+        self.assertEqual(self.timer.rto, 1.0)
+        self.timer.on_rtt_sample(100.0)
+        self.assertEqual(self.timer.rto, 30.0)
+
+    def test_backoff(self) -> None:
+        self.timer.on_timeout()
+        self.assertEqual(self.timer.rto, 10.0)
+        for _ in range(5):
+            self.timer.on_timeout()
+        self.assertEqual(self.timer.rto, 30.0)
+        # A new sample ends the backoff
+        self.timer.on_rtt_sample(2.0)
+        self.assertEqual(self.timer.rto, 6.0)
+
+
+class SessionCipherTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.initiator, self.responder = session_pair()
+        self.datagram: bytes = message_to_datagram(
+            MessageType.CHAT, OperationType.ERR, 1, 'alice', 'hi')
+
+    def test_round_trip(self) -> None:
+        sealed: bytes = self.initiator.seal(self.datagram)
+        self.assertEqual(Datagram(sealed).header.message_type,
+                         MessageType.SECURE)
+        self.assertEqual(Datagram(sealed).header.user, 'alice')
+        self.assertNotIn(b'hi', sealed[39:])
+        self.assertEqual(self.responder.open(sealed), self.datagram)
+        self.assertEqual(self.initiator.open(
+            self.responder.seal(self.datagram)), self.datagram)
+
+    def test_tampered(self) -> None:
+        sealed: bytes = self.initiator.seal(self.datagram)
+        for i in range(len(sealed)):
+            tampered: bytes = sealed[:i] + \
+                bytes([sealed[i] ^ 0x01]) + sealed[i + 1:]
+            with self.assertRaises(ValueError):
+                self.responder.open(tampered)
+        with self.assertRaises(ValueError):
+            self.responder.open(sealed[:-1])
+        # Each direction has its own keys, so a datagram can't be reflected back to its sender
+        with self.assertRaises(ValueError):
+            self.initiator.open(sealed)
+        # Neither can another session open it
+        with self.assertRaises(ValueError):
+            session_pair()[1].open(sealed)
+        self.assertEqual(self.responder.open(sealed), self.datagram)
+
+    def test_replay_window(self) -> None:
+        sealed: List[bytes] = [self.initiator.seal(
+            self.datagram) for _ in range(100)]
+        # Reordering within the window is fine, each datagram is only accepted once
+        for i in [1, 0, 50, 30, 99, 40]:
+            self.assertEqual(self.responder.open(sealed[i]), self.datagram)
+        for i in [1, 0, 50, 99]:
+            with self.assertRaises(ValueError):
+                self.responder.open(sealed[i])
+        # Too old for the window
+        with self.assertRaises(ValueError):
+            self.responder.open(sealed[20])
+
+    def test_replay_window_bitmap(self) -> None:
+        window: ReplayWindow = ReplayWindow(size=4)
+        for nonce in [0, 3, 2]:
+            self.assertTrue(window.check(nonce))
+            window.update(nonce)
+        self.assertFalse(window.check(2))
+        self.assertTrue(window.check(1))
+        window.update(10)
+        self.assertFalse(window.check(6))
+        self.assertTrue(window.check(7))
+
+    def test_invalid_public_keys(self) -> None:
+        for public_key in ['', 'xyz', '0', '1', format(MODP_PRIME - 1, 'x'), format(MODP_PRIME, 'x')]:
+            with self.assertRaises(ValueError):
+                KeyExchange().derive(public_key, initiator=True)
+
+    # A session handed over to a restarted daemon keeps its keys, nonces and replay window
+    def test_snapshot_round_trip(self) -> None:
+        sealed: bytes = self.initiator.seal(self.datagram)
+        self.responder.open(sealed)
+        initiator: SessionCipher = SessionCipher.from_dict(
+            json.loads(json.dumps(self.initiator.to_dict())))
+        responder: SessionCipher = SessionCipher.from_dict(
+            json.loads(json.dumps(self.responder.to_dict())))
+        self.assertEqual(responder.open(
+            initiator.seal(self.datagram)), self.datagram)
+        self.assertEqual(initiator.open(
+            responder.seal(self.datagram)), self.datagram)
+        with self.assertRaises(ValueError):
+            responder.open(sealed)
+
+
+class TimerHeapTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.timers: TimerHeap = TimerHeap()
+        self.timers.start()
+        self.fired: List[int] = []
+        self.done: threading.Event = threading.Event()
+
+    def tearDown(self) -> None:
+        self.timers.stop()
+
+    def test_fires_in_deadline_order(self) -> None:
+        for i in [3, 1, 4, 0, 2]:
+            self.timers.schedule(0.01 * i, self.fired.append, i)
+        self.timers.schedule(0.1, self.done.set)
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.fired, [0, 1, 2, 3, 4])
+
+    def test_earlier_timer_wakes_the_thread(self) -> None:
+        self.timers.schedule(60, self.fired.append, 1)
+        time.sleep(0.05)
+        start: float = time.time()
+        self.timers.schedule(0.01, self.done.set)
+        self.assertTrue(self.done.wait(2))
+        self.assertLess(time.time() - start, 1)
+
+    def test_cancel(self) -> None:
+        timers = [self.timers.schedule(0.01, self.fired.append, i)
+                  for i in range(1000)]
+        for timer in timers[::2]:
+            timer.cancel()
+        self.timers.schedule(0.05, self.done.set)
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.fired, list(range(1, 1000, 2)))
+        self.assertEqual(len(self.timers), 0)
+
+    # A failing callback must not take down the timers of everyone else
+    def test_failing_callback(self) -> None:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            self.timers.schedule(0, lambda: 1 / 0)
+            self.timers.schedule(0.01, self.done.set)
+            self.assertTrue(self.done.wait(2))
+
+
+class ImpairedSocket:
+    # Wraps the UDP socket of a Daemon and loses, duplicates and reorders the datagrams it sends
+    # - a reordered datagram is held back until the next datagram to the same address has been sent (or `reorder_window` passed)
+    # - stop-and-wait with a single bit sequence number can only tell datagrams of neighbouring exchanges apart,
+    #   so a held back datagram is never overtaken by more than one other datagram
+    # - with a `delay` every datagram is sent that many seconds late instead (meant for a network without other impairments)
+    def __init__(self, sock: socket.socket, seed: int, loss: float = 0.05, duplicate: float = 0.05, reorder: float = 0.05, reorder_window: float = 0.002) -> None:
+        self.socket: socket.socket = sock
+        self.rng: random.Random = random.Random(seed)
+        self.loss: float = loss
+        self.duplicate: float = duplicate
+        self.reorder: float = reorder
+        self.reorder_window: float = reorder_window
+        self.delay: float = 0.0
+        self.held: Dict[Tuple[str, int], bytes] = {}
+        self.lock: threading.Lock = threading.Lock()
+        self.lost: int = 0
+        self.duplicated: int = 0
+        self.reordered: int = 0
+
+    def sendto(self, data: bytes, addr: Tuple[str, int]) -> int:
+        if self.delay:
+            threading.Timer(self.delay, self.socket.sendto, (data, addr)).start()
+            return len(data)
+        with self.lock:
+            if self.rng.random() < self.loss:
+                self.lost += 1
+                return len(data)
+            self.send(data, addr, may_hold=True)
+            # The copy is sent right away, so it releases the original if that was held back
+            if self.rng.random() < self.duplicate:
+                self.duplicated += 1
+                self.send(data, addr, may_hold=False)
+        return len(data)
+
+    def send(self, data: bytes, addr: Tuple[str, int], may_hold: bool) -> None:
+        held: Optional[bytes] = self.held.pop(addr, None)
+        if held is None and may_hold and self.rng.random() < self.reorder:
+            self.reordered += 1
+            self.held[addr] = data
+            threading.Timer(self.reorder_window, self.release,
+                            (addr, data)).start()
+            return
+        self.socket.sendto(data, addr)
+        if held is not None:
+            self.socket.sendto(held, addr)
+
+    def release(self, addr: Tuple[str, int], data: bytes) -> None:
+        with self.lock:
+            if self.held.get(addr) is data:
+                del self.held[addr]
+                self.socket.sendto(data, addr)
+
+    def __getattr__(self, name: str):
+        return getattr(self.socket, name)
+
+
+class StalledConnection:
+    # The Daemon's connection to a Client that only reads while `reading` is set
+    def __init__(self, conn: socket.socket, reading: threading.Event) -> None:
+        self.conn: socket.socket = conn
+        self.reading: threading.Event = reading
+
+    def sendall(self, data: bytes) -> None:
+        self.reading.wait()
+        self.conn.sendall(data)
+
+
+class ClientConnection:
+    # A test Client, reading everything the Daemon sends into one buffer
+    # - the Daemon sends its messages without framing, so they are found with regular expressions
+    def __init__(self, host: str, username: str) -> None:
+        self.socket: socket.socket = socket.create_connection((host, 7778))
+        self.buffer: str = ''
+        self.wait_for(r'connection successfully established')
+        self.socket.sendall(username.encode('ascii'))
+
+    def send(self, command: str) -> None:
+        self.socket.sendall(command.encode('ascii'))
+
+    def wait_for(self, pattern: str, timeout: float = 10.0, start: int = 0) -> re.Match:
+        deadline: float = time.time() + timeout
+        while True:
+            match = re.compile(pattern).search(self.buffer, start)
+            if match:
+                return match
+            time_left: float = deadline - time.time()
+            if time_left <= 0:
+                raise AssertionError(
+                    f'Timed out waiting for {pattern!r}, received: {self.buffer[-500:]!r}')
+            self.socket.settimeout(time_left)
+            try:
+                data: bytes = self.socket.recv(65535)
+            except socket.timeout:
+                continue
+            if not data:
+                raise AssertionError(
+                    f'Daemon closed the connection while waiting for {pattern!r}')
+            self.buffer += data.decode('ascii')
+
+    # Read whatever the Daemon sends within `duration`, so late duplicates show up in the buffer
+    def receive_for(self, duration: float) -> None:
+        deadline: float = time.time() + duration
+        while time.time() < deadline:
+            self.socket.settimeout(max(deadline - time.time(), 0.001))
+            try:
+                data: bytes = self.socket.recv(65535)
+            except socket.timeout:
+                continue
+            if not data:
+                return
+            self.buffer += data.decode('ascii')
+
+    def close(self) -> None:
+        self.socket.close()
+
+
+# Every test gets Daemons on new addresses, as the ports of the earlier ones stay bound
+DAEMON_HOSTS = itertools.count(51, 2)
+
+
+class DaemonStressTest(unittest.TestCase):
+    # Two in-process Daemons chatting through impaired loopback sockets
+    # - messages have to arrive exactly once and in order, even though the network loses, duplicates and reorders them
+    def setUp(self) -> None:
+        first_host: int = next(DAEMON_HOSTS)
+        self.hosts: Tuple[str, str] = (
+            f'127.0.0.{first_host}', f'127.0.0.{first_host + 1}')
+        # The Daemons log every datagram
+        self.stdout = contextlib.redirect_stdout(open(os.devnull, 'w'))
+        self.stdout.__enter__()
+        self.daemons: List[Daemon] = []
+        self.sockets: List[ImpairedSocket] = []
+        for i, host in enumerate(self.hosts):
+            try:
+                daemon = Daemon(host)
+            except OSError as e:
+                self.tearDown()
+                self.skipTest(f'Could not bind to {host}: {e}')
+            daemon.retransmission_timer = RetransmissionTimer(
+                initial_rto=0.2, min_rto=0.05, max_rto=1.0)
+            self.daemons.append(daemon)
+            self.sockets.append(self.start_daemon(daemon, i))
+        self.clients: List[ClientConnection] = []
+
+    # Impair the socket of a Daemon and start its listeners
+    def start_daemon(self, daemon: Daemon, i: int) -> ImpairedSocket:
+        # Loss is simulated by the impaired socket, and loopback is fast
+        daemon.drop_probability = 0.0
+        daemon.max_retries = 20
+        impaired: ImpairedSocket = ImpairedSocket(
+            daemon.daemon_socket, FUZZ_SEED + i)
+        daemon.daemon_socket = impaired  # type: ignore[assignment]
+        threading.Thread(target=daemon.start_daemon_listener,
+                         daemon=True).start()
+        threading.Thread(target=daemon.start_client_listener,
+                         daemon=True).start()
+        return impaired
+
+    def tearDown(self) -> None:
+        for client in self.clients:
+            client.close()
+        # Give the Daemons a moment to notice, before their logs go to the terminal again
+        time.sleep(0.2)
+        self.stdout.__exit__(None, None, None)
+
+    # Connect a Client to both Daemons and start a chat between them
+    def start_chat(self) -> Tuple[ClientConnection, ClientConnection]:
+        alice = ClientConnection(self.hosts[0], 'alice')
+        bob = ClientConnection(self.hosts[1], 'bob')
+        self.clients += [alice, bob]
+        time.sleep(0.1)
+        alice.send(f'CONNECT {self.hosts[1]}')
+        bob.wait_for(r'User alice wants to start a chat')
+        bob.send('ACCEPT')
+        alice.wait_for(r'Chat connection established with bob')
+        bob.wait_for(r'Chat connection established with alice')
+        return alice, bob
+
+    def test_exactly_once_in_order(self) -> None:
+        alice, bob = self.start_chat()
+        position: int = len(bob.buffer)
+        for i in range(STRESS_MESSAGES):
+            # The Daemon reads commands without framing, so wait for the delivery before sending the next one
+            alice.send(f'CHAT m{i:06d}')
+            position = bob.wait_for(
+                f'CHAT alice m{i:06d}', start=position).end()
+        # A late duplicate would show up after the last message
+        bob.receive_for(0.5)
+
+        delivered: List[str] = re.findall(r'CHAT alice (m\d{6})', bob.buffer)
+        self.assertEqual(
+            delivered, [f'm{i:06d}' for i in range(STRESS_MESSAGES)])
+        self.assertNotIn('timed out', alice.buffer + bob.buffer)
+        # Make sure the network really was impaired
+        for impaired in self.sockets:
+            self.assertGreater(impaired.lost, 0)
+        self.assertGreater(sum(impaired.duplicated for impaired in self.sockets), 0)
+        self.assertGreater(sum(impaired.reordered for impaired in self.sockets), 0)
+
+    # The Daemons find each other's users through ANNOUNCE datagrams, so a chat can be started by username
+    def test_discovery(self) -> None:
+        for daemon, peer in zip(self.daemons, reversed(self.hosts)):
+            daemon.discovery_targets = [(peer, 7777)]
+            daemon.announce_interval = 0.2
+        alice = ClientConnection(self.hosts[0], 'alice')
+        bob = ClientConnection(self.hosts[1], 'bob')
+        self.clients += [alice, bob]
+        time.sleep(0.1)
+        for daemon in self.daemons:
+            daemon.start_discovery_announcer()
+        deadline: float = time.time() + 5
+        while not all(daemon.peer_cache.resolve(username) for daemon, username in zip(self.daemons, ['bob', 'alice'])):
+            self.assertLess(time.time(), deadline, 'Daemons did not discover each other')
+            time.sleep(0.05)
+        self.assertEqual(self.daemons[0].peer_cache.resolve('bob'), (self.hosts[1], 7777))
+        self.assertEqual(self.daemons[1].peer_cache.resolve('alice'), (self.hosts[0], 7777))
+
+        alice.send('CONNECT carol')
+        alice.wait_for('unknown user carol')
+        alice.send('CONNECT bob')
+        bob.wait_for(r'User alice wants to start a chat')
+        bob.send('ACCEPT')
+        alice.wait_for(r'Chat connection established with bob')
+        alice.send('CHAT found you')
+        bob.wait_for('CHAT alice found you')
+
+    # By default the announcements are broadcast, and received on the discovery socket (loopback delivers
+    # broadcasts from a loopback address, so this works with the Daemons of the test too)
+    def test_discovery_by_broadcast(self) -> None:
+        for daemon in self.daemons:
+            self.assertEqual(daemon.discovery_targets, [('<broadcast>', 7777)])
+            if daemon.discovery_socket is None:
+                self.skipTest('Could not bind to the broadcast address')
+            daemon.announce_interval = 0.2
+            threading.Thread(target=daemon.start_discovery_listener,
+                             daemon=True).start()
+        alice = ClientConnection(self.hosts[0], 'alice')
+        bob = ClientConnection(self.hosts[1], 'bob')
+        self.clients += [alice, bob]
+        time.sleep(0.1)
+        for daemon in self.daemons:
+            daemon.start_discovery_announcer()
+        deadline: float = time.time() + 5
+        while not all(daemon.peer_cache.resolve(username) for daemon, username in zip(self.daemons, ['bob', 'alice'])):
+            self.assertLess(time.time(), deadline, 'Daemons did not discover each other')
+            time.sleep(0.05)
+        self.assertEqual(self.daemons[0].peer_cache.resolve('bob'), (self.hosts[1], 7777))
+        self.assertEqual(self.daemons[1].peer_cache.resolve('alice'), (self.hosts[0], 7777))
+        alice.send('CONNECT bob')
+        bob.wait_for(r'User alice wants to start a chat')
+
+    # Only ACKs of datagrams sent once are RTT samples (Karn's algorithm), the credit comes with every ACK
+    def test_ack_credit_and_rtt(self) -> None:
+        daemon: Daemon = self.daemons[0]
+        timer: RetransmissionTimer = daemon.retransmission_timer
+        daemon.last_send_time = time.time() - 0.5
+        daemon.transmissions = 2
+        daemon.handle_ack_credit_and_rtt(Datagram(message_to_datagram(
+            MessageType.CONTROL, OperationType.ACK, 0, 'bob', '0')))
+        self.assertIsNone(timer.srtt)
+        self.assertEqual(daemon.peer_credit, 0)
+        daemon.transmissions = 1
+        daemon.handle_ack_credit_and_rtt(Datagram(message_to_datagram(
+            MessageType.CONTROL, OperationType.ACK, 0, 'bob', '')))
+        self.assertAlmostEqual(timer.srtt, 0.5, delta=0.1)  # type: ignore[arg-type]
+        # Daemons that don't advertise credit are not flow controlled
+        self.assertIsNone(daemon.peer_credit)
+
+    # Bob's Client stops reading: his Daemon buffers what fits, advertises no credit and drops the rest,
+    # while Alice's Daemon keeps probing instead of giving up, until Bob reads again
+    def test_client_stops_reading(self) -> None:
+        sender, receiver = self.daemons
+        receiver.client_buffer_size = 4
+        reading: threading.Event = threading.Event()
+        reading.set()
+        write = receiver.client_writer
+        receiver.client_writer = lambda conn, client_queue: write(  # type: ignore[method-assign]
+            StalledConnection(conn, reading), client_queue)  # type: ignore[arg-type]
+        alice, bob = self.start_chat()
+        # Probes while Bob has no credit must not count as retries (loss would, so there is none here)
+        for impaired in self.sockets:
+            impaired.loss = 0.0
+        sender.max_retries = 2
+
+        reading.clear()
+        for i in range(6):
+            alice.send(f'CHAT m{i}')
+            time.sleep(0.3)
+        # The writer holds m0, m1 to m4 fill the buffer, m5 has to wait
+        self.assertEqual(receiver.client_queue.qsize(), 4)
+        self.assertEqual(sender.peer_credit, 0)
+        self.assertTrue(sender.pending_ack)
+        # Re-ACKs advertise the credit there is now, not the one cached with the ACK
+        sent: List[bytes] = []
+        receiver.send_datagram = lambda datagram, addr: sent.append(  # type: ignore[method-assign]
+            datagram)
+        last: Datagram = Datagram(message_to_datagram(
+            MessageType.CHAT, OperationType.ERR, receiver.expected_sequence_number ^ 1, 'alice', 'm4'))
+        receiver.client_buffer_size = 10
+        receiver.handle_datagram(last, (self.hosts[0], 7777), authenticated=True)
+        self.assertEqual([Datagram(ack).payload.message for ack in sent], ['6'])
+        receiver.client_buffer_size = 4
+        del receiver.send_datagram  # type: ignore[method-assign]
+
+        time.sleep(1.0)
+        self.assertTrue(sender.pending_ack)
+        reading.set()
+        position: int = 0
+        for i in range(6):
+            position = bob.wait_for(f'CHAT alice m{i}', start=position).end()
+        self.assertNotIn('timed out', alice.buffer + bob.buffer)
+
+    # Within a session, datagrams that are not sealed with its keys are dropped
+    def test_spoofed_datagrams_are_dropped(self) -> None:
+        alice, bob = self.start_chat()
+        daemon: Daemon = self.daemons[0]
+        bob_addr: Tuple[str, int] = (self.hosts[1], 7777)
+        fin: bytes = message_to_datagram(
+            MessageType.CONTROL, OperationType.FIN, daemon.expected_sequence_number, 'bob', '')
+        daemon.handle_datagram(Datagram(fin), bob_addr)
+        self.assertTrue(daemon.is_in_chat)
+        # Sealed, but not with the keys of this session
+        with self.assertRaises(ValueError):
+            daemon.open_datagram(session_pair()[0].seal(fin), bob_addr)
+
+        # Anyone else on the network, claiming to be Bob, neither gets into the chat nor ends it
+        spoofer: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(spoofer.close)
+        spoofer.bind((f'127.0.0.{next(DAEMON_HOSTS)}', 7777))
+        for datagram in [message_to_datagram(MessageType.CHAT, OperationType.ERR, daemon.expected_sequence_number, 'bob', 'INJECTED'),
+                         message_to_datagram(MessageType.CONTROL, OperationType.ERR, daemon.expected_sequence_number, 'bob', 'INJECTED'),
+                         message_to_datagram(MessageType.CONTROL, OperationType.FINERR, daemon.expected_sequence_number, 'bob', 'INJECTED'),
+                         message_to_datagram(MessageType.CONTROL, OperationType.ACK, daemon.send_sequence_number, 'bob', '0'),
+                         fin]:
+            spoofer.sendto(datagram, (self.hosts[0], 7777))
+        alice.receive_for(0.5)
+        self.assertNotIn('INJECTED', alice.buffer)
+        self.assertTrue(daemon.is_in_chat)
+        self.assertTrue(daemon.has_active_session(bob_addr))
+        self.assertIsNone(daemon.peer_credit)
+
+        alice.send('CHAT still here')
+        bob.wait_for('CHAT alice still here')
+        self.assertNotIn('ended the chat', alice.buffer)
+        self.assertNotIn('could not be established', alice.buffer)
+
+    # A third party invites Alice while her chat message waits for Bob's (late) ACK: the listener rejects it with
+    # a FINERR and receives its ACK itself, which must neither end the wait of the chat message nor lose Bob's ACK
+    def test_third_party_ack_during_send(self) -> None:
+        alice, bob = self.start_chat()
+        for impaired in self.sockets:
+            impaired.loss = impaired.duplicate = impaired.reorder = 0.0
+        self.sockets[1].delay = 0.3
+        inviter: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(inviter.close)
+        inviter.bind((f'127.0.0.{next(DAEMON_HOSTS)}', 7777))
+        inviter.settimeout(5)
+
+        alice.send('CHAT one')
+        time.sleep(0.05)
+        inviter.sendto(message_to_datagram(MessageType.CONTROL, OperationType.SYN, 0, 'mallory',
+                                           KeyExchange().public_key), (self.hosts[0], 7777))
+        finerr: Datagram = Datagram(inviter.recv(65535))
+        self.assertEqual(finerr.header.operation, OperationType.FINERR)
+        inviter.sendto(message_to_datagram(MessageType.CONTROL, OperationType.ACK,
+                                           finerr.header.sequence_number, 'mallory', ''), (self.hosts[0], 7777))
+        bob.wait_for('CHAT alice one')
+        alice.wait_for('User mallory tried to start a chat')
+
+        alice.send('CHAT two')
+        bob.wait_for('CHAT alice two')
+        with self.daemons[0].ack_condition:
+            self.assertTrue(self.daemons[0].ack_condition.wait_for(
+                lambda: not self.daemons[0].pending_ack, 5))
+        self.assertEqual(self.daemons[0].send_sequence_number, self.daemons[1].expected_sequence_number)
+        self.assertNotIn('timed out', alice.buffer + bob.buffer)
+
+    def test_keepalive(self) -> None:
+        for daemon in self.daemons:
+            daemon.keepalive_interval = 0.2
+            daemon.keepalive_probe_interval = 0.1
+            daemon.keepalive_probes = 5
+        alice, bob = self.start_chat()
+        # An idle chat stays up, as the keepalives are answered (even with some of them lost)
+        time.sleep(2)
+        self.assertTrue(self.daemons[0].is_in_chat)
+        self.assertTrue(self.daemons[1].is_in_chat)
+        alice.send('CHAT still here')
+        bob.wait_for('CHAT alice still here')
+
+        # Bob's Daemon disappears, Alice's notices within the keepalive bound and cleans up after it
+        self.sockets[1].loss = 1.0
+        bob_addr: Tuple[str, int] = (self.hosts[1], 7777)
+        start: float = time.time()
+        alice.wait_for('peer stopped responding', timeout=5)
+        daemon: Daemon = self.daemons[0]
+        self.assertLess(time.time() - start, daemon.keepalive_interval +
+                        daemon.keepalive_probes * daemon.keepalive_probe_interval + 0.5)
+        self.assertFalse(daemon.is_in_chat)
+        self.assertNotIn(bob_addr, daemon.sessions)
+        self.assertIsNone(daemon.keepalive_timer)
+
+    # Bob's Daemon disappears while Alice's is retransmitting a chat message to it, which takes longer than the
+    # keepalive bound: the retransmissions probe Bob already, so the keepalive leaves dropping the chat to the send
+    def test_keepalive_during_send(self) -> None:
+        for daemon in self.daemons:
+            daemon.keepalive_interval = 0.2
+            daemon.keepalive_probe_interval = 0.1
+            daemon.keepalive_probes = 5
+        alice, bob = self.start_chat()
+        daemon: Daemon = self.daemons[0]
+        daemon.max_retries = 3
+        daemon.retransmission_timer = RetransmissionTimer(
+            initial_rto=0.5, min_rto=0.5, max_rto=1.0)
+        self.sockets[1].loss = 1.0
+        alice.send('CHAT anyone there')
+        alice.wait_for('Connection timed out, exiting chat', timeout=5)
+        alice.receive_for(0.5)
+        self.assertEqual(alice.buffer.count('timed out'), 1)
+        self.assertFalse(daemon.is_in_chat)
+
+        # A send whose chat is dropped meanwhile gives up right away, instead of timing out (and dropping it) again
+        # (the SYN is not retransmitted, so it must not be lost)
+        for impaired in self.sockets:
+            impaired.loss = 0.0
+        position: int = bob.wait_for('timed out').end()
+        alice.send(f'CONNECT {self.hosts[1]}')
+        bob.wait_for(r'User alice wants to start a chat', start=position)
+        bob.send('ACCEPT')
+        alice.wait_for(r'Chat connection established with bob', start=alice.buffer.index('timed out'))
+        self.sockets[1].loss = 1.0
+        alice.send('CHAT still anyone there')
+        time.sleep(0.2)
+        daemon.drop_chat((self.hosts[1], 7777), 'Dropped by the test.')
+        with daemon.ack_condition:
+            self.assertTrue(daemon.ack_condition.wait_for(
+                lambda: not daemon.pending_ack, 0.5))
+        alice.receive_for(2.5)
+        self.assertEqual(alice.buffer.count('timed out'), 1)
+        self.assertEqual(alice.buffer.count('Dropped by the test.'), 1)
+
+    # Alice starts a group with Bob and Carol, whose Daemons ACK every message on their own
+    # - Carol's Daemon stops answering, so Alice's keeps retransmitting to it until it drops it, without holding up Bob
+    def test_group_chat(self) -> None:
+        try:
+            daemon = Daemon(f'127.0.0.{next(DAEMON_HOSTS)}')
+        except OSError as e:
+            self.skipTest(f'Could not bind a third Daemon: {e}')
+        self.daemons.append(daemon)
+        self.sockets.append(self.start_daemon(daemon, 2))
+        alice = ClientConnection(self.hosts[0], 'alice')
+        bob = ClientConnection(self.hosts[1], 'bob')
+        carol = ClientConnection(daemon.host, 'carol')
+        self.clients += [alice, bob, carol]
+        time.sleep(0.1)
+        alice.send(f'GROUP {self.hosts[1]} {daemon.host}')
+        alice.wait_for('Group chat established')
+        group: GroupSession = self.daemons[0].group_session  # type: ignore[assignment]
+        group.retransmission_timer = RetransmissionTimer(
+            initial_rto=0.2, min_rto=0.05, max_rto=1.0)
+        group.max_retries = 20
+
+        positions: List[int] = [0, 0]
+        for i in range(20):
+            alice.send(f'CHAT g{i:02d}')
+            for j, member in enumerate([bob, carol]):
+                positions[j] = member.wait_for(
+                    f'GROUP alice g{i:02d}', start=positions[j]).end()
+        for member in [bob, carol]:
+            member.receive_for(0.5)
+            self.assertEqual(re.findall(r'GROUP alice (g\d{2})', member.buffer),
+                             [f'g{i:02d}' for i in range(20)])
+        with group.lock:
+            self.assertEqual(group.pending, 0)
+            self.assertEqual(group.next_message, [20, 20])
+            self.assertEqual(group.log, [])
+
+        # Carol's Daemon still receives, but its ACKs are lost
+        self.sockets[2].loss = 1.0
+        group.max_retries = 3
+        alice.send('CHAT late')
+        bob.wait_for('GROUP alice late')
+        alice.wait_for(f'Group member at {daemon.host} was dropped: connection timed out')
+        self.assertEqual(group.active, 0b01)
+        carol.receive_for(0.5)
+        self.assertEqual(carol.buffer.count('GROUP alice late'), 1)
+        alice.send('CHAT after')
+        bob.wait_for('GROUP alice after')
+        self.assertNotIn('GROUP alice after', carol.buffer)
+
+        # Once Bob is dropped as well the group has ended, so Alice can be invited again
+        self.sockets[1].loss = 1.0
+        alice.send('CHAT last')
+        alice.wait_for('No members left, group chat ended')
+        self.assertFalse(self.daemons[0].in_group_chat())
+        self.sockets[1].loss = 0.0
+        bob.send(f'CONNECT {self.hosts[0]}')
+        alice.wait_for('User bob wants to start a chat')
+
+    # Group members deliver the messages of a group exactly once, and the first message of a new group
+    # from the same sender even if it looks like the last one of the old group
+    def test_group_duplicates_and_new_group(self) -> None:
+        alice = ClientConnection(self.hosts[0], 'alice')
+        bob = ClientConnection(self.hosts[1], 'bob')
+        self.clients += [alice, bob]
+        time.sleep(0.1)
+        member: Daemon = self.daemons[1]
+        alice_addr: Tuple[str, int] = (self.hosts[0], 7777)
+        # The late retransmission of "hello" has the sequence number of the message after "second"
+        for group_id, message_number, message in [('00000001', 0, 'hello'), ('00000001', 1, 'second'),
+                                                  ('00000001', 0, 'hello'), ('00000002', 0, 'hello')]:
+            member.handle_datagram(Datagram(message_to_datagram(
+                MessageType.GROUP, OperationType.ERR, message_number % 2, 'alice', f'{group_id}{message_number:08x} {message}')), alice_addr)
+        bob.receive_for(0.5)
+        self.assertEqual(re.findall(r'GROUP alice (hello|second)', bob.buffer), ['hello', 'second', 'hello'])
+        self.assertEqual(member.group_senders[alice_addr], ('00000002', 1))
+
+        # Leaving ends the group without quitting
+        alice.send(f'GROUP {self.hosts[1]}')
+        alice.wait_for('Group chat established')
+        alice.send('LEAVE')
+        alice.wait_for('You left, group chat ended')
+        self.assertIsNone(self.daemons[0].group_session)
+        alice.send('LEAVE')
+        alice.wait_for('Not in a group chat')
+
+    # Bob's Daemon is restarted in the middle of the chat, what Alice sends meanwhile waits in its socket
+    # - the restart is done in-process, the new Daemon takes over the sockets and the snapshot of the old one
+    def test_hot_restart(self) -> None:
+        alice, bob = self.start_chat()
+        position: int = len(bob.buffer)
+        for i in range(40):
+            if i == 20:
+                old: Daemon = self.daemons[1]
+                restarter: threading.Thread = threading.Thread(
+                    target=self.restart_daemon, args=(1,))
+                restarter.start()
+            alice.send(f'CHAT m{i:02d}')
+            position = bob.wait_for(f'CHAT alice m{i:02d}', start=position).end()
+        restarter.join()
+        self.assertIsNot(self.daemons[1], old)
+        self.assertTrue(self.daemons[1].is_in_chat)
+        # The restarted Daemon continues the sequence numbers and the session
+        bob.send('CHAT welcome back')
+        alice.wait_for('CHAT bob welcome back')
+        time.sleep(0.5)
+        delivered: List[str] = re.findall(r'CHAT alice (m\d{2})', bob.buffer)
+        self.assertEqual(delivered, [f'm{i:02d}' for i in range(40)])
+        self.assertNotIn('timed out', alice.buffer + bob.buffer)
+        self.assertNotIn('ended the chat', alice.buffer + bob.buffer)
+
+    # The listener of Bob's Daemon is still handling a datagram (e.g. waiting for the ACKs of its reply) when the restart
+    # starts, and has deferred another one: the restart waits for it, and the new Daemon handles the deferred datagram
+    def test_hot_restart_waits_for_listener(self) -> None:
+        bob = ClientConnection(self.hosts[1], 'bob')
+        self.clients.append(bob)
+        time.sleep(0.1)
+        daemon: Daemon = self.daemons[1]
+        alice_addr: Tuple[str, int] = (self.hosts[0], 7777)
+        handling: threading.Event = threading.Event()
+        handle = daemon.handle_datagram
+
+        def slow_handle(message_received: Datagram, addr: Tuple[str, int], authenticated: bool = False) -> None:
+            handling.set()
+            time.sleep(6)
+            daemon.deferred_datagrams.append((Datagram(message_to_datagram(
+                MessageType.GROUP, OperationType.ERR, 1, 'alice', '0000000100000001 deferred')), alice_addr, False))
+            handle(message_received, addr, authenticated)
+        daemon.handle_datagram = slow_handle  # type: ignore[method-assign]
+        self.daemons[0].daemon_socket.sendto(message_to_datagram(
+            MessageType.GROUP, OperationType.ERR, 0, 'alice', '0000000100000000 first'), (self.hosts[1], 7777))
+        self.assertTrue(handling.wait(5))
+
+        start: float = time.time()
+        self.restart_daemon(1)
+        self.assertGreater(time.time() - start, 5)
+        position: int = bob.wait_for('GROUP alice first').end()
+        bob.wait_for('GROUP alice deferred', start=position)
+        bob.receive_for(0.5)
+        self.assertEqual(bob.buffer.count('GROUP alice'), 2)
+        self.assertEqual(self.daemons[1].group_senders[alice_addr], ('00000001', 2))
+
+    def restart_daemon(self, i: int) -> None:
+        # The snapshot has to survive being written to a file
+        snapshot: Dict = json.loads(json.dumps(
+            self.daemons[i].prepare_restart()))
+        daemon: Daemon = Daemon(self.hosts[i], snapshot=snapshot)
+        self.sockets[i] = self.start_daemon(daemon, i)
+        self.daemons[i] = daemon
+
+
+def measure_throughput(operation, iterations: int = 20000, repeats: int = 5) -> float:
+    # Operations per second, best of `repeats` runs to reduce the noise of other processes
+    best: float = float('inf')
+    for _ in range(repeats):
+        start: float = time.perf_counter()
+        for _ in range(iterations):
+            operation()
+        best = min(best, time.perf_counter() - start)
+    return iterations / best
+
+
+def run_benchmarks() -> Dict[str, float]:
+    chat: bytes = message_to_datagram(
+        MessageType.CHAT, OperationType.ERR, 1, 'alice', 'Hello there, how are you doing?')
+    ack: bytes = message_to_datagram(
+        MessageType.CONTROL, OperationType.ACK, 1, 'bob', '32')
+    sender, receiver = session_pair()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        log_chat_per_second: float = measure_throughput(
+            lambda: log_datagram(chat))
+    return {
+        'seal_and_open_chat_per_second': measure_throughput(lambda: receiver.open(sender.seal(chat))),
+        'log_chat_per_second': log_chat_per_second,
+        'parse_chat_per_second': measure_throughput(lambda: Datagram(chat)),
+        'parse_ack_per_second': measure_throughput(lambda: Datagram(ack)),
+        'encode_chat_per_second': measure_throughput(lambda: message_to_datagram(
+            MessageType.CHAT, OperationType.ERR, 1, 'alice', 'Hello there, how are you doing?')),
+        'encode_ack_per_second': measure_throughput(lambda: message_to_datagram(
+            MessageType.CONTROL, OperationType.ACK, 1, 'bob', '32')),
+    }
+
+
+def session_pair() -> Tuple[SessionCipher, SessionCipher]:
+    initiator: KeyExchange = KeyExchange()
+    responder: KeyExchange = KeyExchange()
+    return initiator.derive(responder.public_key, initiator=True), responder.derive(initiator.public_key, initiator=False)
+
+
+# What the Daemon does for every datagram it sends or receives
+def log_datagram(data: bytes) -> None:
+    print(
+        f"\n<-----------\nDAEMON: Received datagram (in handle) from ('127.0.0.1', 7777):\n{Datagram(data)}\n<-----------\n")
+
+
+class ThroughputRegressionTest(unittest.TestCase):
+    # Encryption should cost less than the logging every datagram already gets on both sides
+    # (logging is measured into /dev/null, a terminal is a lot slower than that)
+    def test_encryption_overhead(self) -> None:
+        results: Dict[str, float] = run_benchmarks()
+        encryption_cost: float = 1 / results['seal_and_open_chat_per_second']
+        logging_cost: float = 2 / results['log_chat_per_second']
+        self.assertLess(encryption_cost, logging_cost,
+                        f'Sealing and opening takes {encryption_cost * 1e6:.1f}us, logging {logging_cost * 1e6:.1f}us')
+
+    def test_throughput(self) -> None:
+        # Logging is only the yardstick for the encryption overhead, it is not gated itself
+        results: Dict[str, float] = {name: value for name, value in run_benchmarks().items()
+                                     if not name.startswith('log_')}
+        if os.environ.get('SIMP_UPDATE_BASELINE') == '1':
+            with open(BASELINE_PATH, 'w') as f:
+                json.dump({name: round(value) for name, value in results.items()},
+                          f, indent=2, sort_keys=True)
+                f.write('\n')
+            return
+        # A missing baseline must not turn the gate off
+        if not os.path.exists(BASELINE_PATH):
+            self.fail(
+                f'No benchmark baseline at {BASELINE_PATH}, store one with SIMP_UPDATE_BASELINE=1')
+        with open(BASELINE_PATH) as f:
+            baseline: Dict[str, float] = json.load(f)
+        for name, value in results.items():
+            self.assertIn(name, baseline,
+                          f'{name} has no baseline, store one with SIMP_UPDATE_BASELINE=1')
+            minimum: float = baseline[name] * (1 - BENCHMARK_TOLERANCE)
+            self.assertGreaterEqual(
+                value, minimum, f'{name} regressed: {value:.0f}/s, baseline {baseline[name]:.0f}/s')
+
+
+if __name__ == '__main__':
+    unittest.main()